@@ -1,14 +1,31 @@
 import base64
+import hashlib
 import json
 import logging
 import os
+import random
+import time
 import uuid
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger()
 
-bedrock_client = boto3.client("bedrock-runtime", region_name="us-west-2")
+# Timeouts of a model call, which invoke_with_retries retries instead of the
+# client, so that the longest a review can take is known
+MODEL_CONNECT_TIMEOUT_SECONDS = 10
+MODEL_READ_TIMEOUT_SECONDS = int(os.environ.get("REVIEW_MODEL_TIMEOUT", 180))
+bedrock_client = boto3.client(
+    "bedrock-runtime",
+    region_name="us-west-2",
+    config=Config(
+        connect_timeout=MODEL_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=MODEL_READ_TIMEOUT_SECONDS,
+        retries={"total_max_attempts": 1},
+    ),
+)
 s3_client = boto3.client("s3")
 dynamodb_client = boto3.client("dynamodb")
 
@@ -25,6 +42,463 @@ Where issue_found indicates if there is any issue with the language. When there
 and “feedback” should provide the reasoning behind the suggestion.
 """
 
+MODEL_ID = "anthropic.claude-3-opus-20240229-v1:0"
+# Number of sections reviewed by one model call in batch mode
+REVIEW_BATCH_SIZE = int(os.environ.get("REVIEW_BATCH_SIZE", 8))
+# Sections of a batch request, whose reviews must be generated within the
+# 29 s integration timeout of API Gateway. Whole files are reviewed by the
+# review job instead.
+MAX_SYNC_SECTIONS = int(os.environ.get("REVIEW_MAX_SYNC_SECTIONS", 4))
+MAX_TOKENS_PER_SECTION = 500
+MAX_TOKENS = 4096
+# Attempts of a model call, and the exponential backoff between them
+MAX_ATTEMPTS = int(os.environ.get("REVIEW_MAX_ATTEMPTS", 3))
+BACKOFF_BASE_SECONDS = float(os.environ.get("REVIEW_BACKOFF_BASE_SECONDS", 1))
+BACKOFF_MAX_SECONDS = float(os.environ.get("REVIEW_BACKOFF_MAX_SECONDS", 30))
+if MAX_ATTEMPTS < 1:
+    raise ValueError("REVIEW_MAX_ATTEMPTS must be at least 1")
+# Longest invoke_with_retries can take, when every attempt times out and
+# waits the longest backoff
+MAX_RETRIES_SECONDS = MAX_ATTEMPTS * (
+    MODEL_CONNECT_TIMEOUT_SECONDS + MODEL_READ_TIMEOUT_SECONDS
+) + sum(
+    min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    for attempt in range(MAX_ATTEMPTS - 1)
+)
+REVIEW_CACHE_TTL_SECONDS = (
+    int(os.environ.get("REVIEW_CACHE_TTL_DAYS", 30)) * 24 * 3600
+)
+# Cached reviews are only reused for the same model and system prompt
+SYSTEM_PROMPT_HASH = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+METRICS_NAMESPACE = "LegalLM"
+THROTTLING_ERRORS = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+}
+
+
+def context_prompt(original_text, batch=False):
+    next_message = (
+        "numbered sections from the contract for review"
+        if batch
+        else "a section from the contract for review"
+    )
+    return f"""
+        I will first provide you with the full contract for context. Please
+        acknowledge only with a yes or no it you would like to proceed.
+        The next message will contain {next_message}.
+        Please provide your feedback in json format.
+
+        The full contract is as follows:
+        --------------------------------
+        {original_text}
+        """
+
+
+def batch_prompt(sections):
+    numbered = "\n".join(
+        f"[{i}] {section}" for i, section in enumerate(sections)
+    )
+    return f"""
+        I will now provide you with {len(sections)} numbered sections from
+        the contract for review. Review each section on its own, and reply
+        with only a JSON array holding one feedback object per section, in
+        the same order as the sections, with an additional "section" field
+        set to the number of the section.
+        --------------------------------
+        {numbered}
+        """
+
+
+def invoke_model(messages, max_tokens=1000, client=None):
+    """
+    Send a conversation to the review model.
+
+    Args:
+        messages (list): Messages following the system prompt.
+        max_tokens (int): Maximum number of tokens of the response.
+        client: Bedrock runtime client, defaults to bedrock_client.
+
+    Returns:
+        tuple: The text of the response, and its token usage.
+    """
+    resp = (client or bedrock_client).invoke_model(
+        modelId=MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps(
+            {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": max_tokens,
+                "system": SYSTEM_PROMPT,
+                "messages": messages,
+            }
+        ),
+    )
+    resp_json = json.loads(resp["body"].read())
+    return resp_json["content"][-1]["text"], resp_json.get("usage", {})
+
+
+def backoff_delay(attempt):
+    # Full jitter, so that throttled concurrent calls do not retry together
+    return random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+    )
+
+
+def invoke_with_retries(messages, parse, max_tokens=1000, client=None):
+    """
+    Send a conversation to the review model until its response parses.
+
+    Throttled calls and responses that fail to parse are retried up to
+    MAX_ATTEMPTS times, with exponential backoff and jitter.
+
+    Args:
+        messages (list): Messages following the system prompt.
+        parse (callable): Function parsing the text of the response, and
+            raising an exception when it is malformed.
+        max_tokens (int): Maximum number of tokens of the response.
+        client: Bedrock runtime client, defaults to bedrock_client.
+
+    Returns:
+        tuple: The parsed response, and its token usage.
+    """
+    for i in range(MAX_ATTEMPTS):
+        try:
+            review, usage = invoke_model(messages, max_tokens, client)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code not in THROTTLING_ERRORS or i == MAX_ATTEMPTS - 1:
+                raise
+            logger.warning(f"Model call throttled ({code}) on attempt {i}")
+        else:
+            try:
+                return parse(review), usage
+            except Exception as e:
+                logger.warning(
+                    f"Failed to parse response as JSON: {review} on "
+                    f"attempt {i}"
+                )
+                logger.warning(f"Error: {str(e)} encountered, retrying...")
+                if i == MAX_ATTEMPTS - 1:
+                    logger.error(
+                        "Failed to parse response as JSON after "
+                        f"{MAX_ATTEMPTS} attempts"
+                    )
+                    raise ValueError("Failed to parse response as JSON")
+        time.sleep(backoff_delay(i))
+
+
+def parse_review(review):
+    json.loads(review, strict=False)
+    return review
+
+
+def parse_batch_review(review, num_sections):
+    """
+    Split the response to a batch of sections into one review per section.
+
+    Args:
+        review (str): Text of the model response.
+        num_sections (int): Number of sections in the batch.
+
+    Returns:
+        list: The feedback object of each section, in order.
+    """
+    # The array is sometimes surrounded by sentences from the model, which
+    # can contain brackets too, e.g. "Reviews of sections [0]-[7]:"
+    decoder = json.JSONDecoder(strict=False)
+    start = review.find("[")
+    while True:
+        if start == -1:
+            raise ValueError("No JSON array of objects in the response")
+        try:
+            reviews, _ = decoder.raw_decode(review, start)
+        except json.JSONDecodeError:
+            reviews = None
+        if reviews and all(isinstance(r, dict) for r in reviews):
+            break
+        start = review.find("[", start + 1)
+    if len(reviews) != num_sections:
+        raise ValueError(f"Expected a JSON array of {num_sections} reviews")
+    # Each section must be reviewed exactly once, so that no review is
+    # attributed to the wrong section
+    numbers = [r.get("section") for r in reviews]
+    if sorted(
+        n if isinstance(n, int) and not isinstance(n, bool) else -1
+        for n in numbers
+    ) != list(range(num_sections)):
+        raise ValueError(
+            f"Expected sections 0 to {num_sections - 1}, got {numbers}"
+        )
+    return sorted(reviews, key=lambda r: r["section"])
+
+
+def review_batch(original_text, sections, client=None):
+    """
+    Review several sections with one model call.
+
+    The contract is sent once for the whole batch, where reviewing each
+    section on its own sends it once per section.
+
+    Args:
+        original_text (str): The full contract.
+        sections (list): Texts of the sections.
+        client: Bedrock runtime client, defaults to bedrock_client.
+
+    Returns:
+        tuple: The review of each section, and the token usage of the call
+        with the input tokens that per-section calls would have used.
+    """
+    initial_prompt = context_prompt(original_text, batch=True)
+    review_prompt = batch_prompt(sections)
+    messages = [
+        {"role": "user", "content": initial_prompt},
+        {"role": "assistant", "content": "yes"},
+        {"role": "user", "content": review_prompt},
+    ]
+    max_tokens = min(MAX_TOKENS, MAX_TOKENS_PER_SECTION * len(sections))
+
+    reviews, usage = invoke_with_retries(
+        messages,
+        lambda review: parse_batch_review(review, len(sections)),
+        max_tokens,
+        client,
+    )
+
+    # Bedrock only reports the total input tokens, the share of the shared
+    # context is estimated from its share of the characters
+    input_tokens = usage.get("input_tokens", 0)
+    shared_chars = len(SYSTEM_PROMPT) + len(initial_prompt) + len("yes")
+    total_chars = shared_chars + len(review_prompt)
+    shared_tokens = input_tokens * shared_chars / total_chars
+    return reviews, {
+        "input_tokens": input_tokens,
+        "output_tokens": usage.get("output_tokens", 0),
+        "per_section_input_tokens": round(
+            input_tokens + (len(sections) - 1) * shared_tokens
+        ),
+    }
+
+
+def load_sections(metadata, sections):
+    """
+    Resolve the sections of a batch request to their texts.
+
+    Args:
+        metadata (dict): DynamoDB item of the file.
+        sections (list): Texts of sections, or indexes of sentences in the
+            structured json file of the file.
+
+    Returns:
+        list: The texts of the sections.
+    """
+    if not all(
+        isinstance(section, (str, int)) and not isinstance(section, bool)
+        for section in sections
+    ):
+        raise ValueError("Sections must be texts or sentence indexes")
+    if not any(isinstance(section, int) for section in sections):
+        return sections
+    s3_response = s3_client.get_object(
+        Bucket=os.environ["S3_BUCKET"], Key=metadata["structured_file"]["S"]
+    )
+    segments = json.loads(s3_response["Body"].read())["segments"]
+    for section in sections:
+        if isinstance(section, int) and not 0 <= section < len(segments):
+            raise ValueError(f"Sentence index {section} is out of range")
+    return [
+        segments[section] if isinstance(section, int) else section
+        for section in sections
+    ]
+
+
+def cache_key(review_text, mode):
+    """
+    Build the sort key of a review in the review cache.
+
+    Args:
+        review_text (str): Text of the reviewed section.
+        mode (str): "single" or "batch", the prompts of the two modes
+            differ so their reviews are cached apart.
+
+    Returns:
+        str: The model ID, the hashes of the system prompt and of the
+        section, and the mode.
+    """
+    review_hash = hashlib.sha256(review_text.encode("utf-8")).hexdigest()
+    return f"{MODEL_ID}#{SYSTEM_PROMPT_HASH}#{mode}#{review_hash}"
+
+
+def log_metrics(metrics):
+    """
+    Log counts in the CloudWatch embedded metric format, which CloudWatch
+    turns into metrics without any call from the function.
+
+    Args:
+        metrics (dict): Count of each metric name.
+    """
+    # The line must be the JSON document alone, without the logger prefix
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [[]],
+                            "Metrics": [
+                                {"Name": name, "Unit": "Count"}
+                                for name in metrics
+                            ],
+                        }
+                    ],
+                },
+                **metrics,
+            }
+        )
+    )
+
+
+def get_cached_reviews(file_id, keys):
+    """
+    Look up reviews in the review cache.
+
+    Args:
+        file_id (str): ID of the file.
+        keys (list): Cache keys of the reviews.
+
+    Returns:
+        dict: The cached review of each key found, hits and misses are
+        logged as CloudWatch metrics.
+    """
+    table = os.environ["DYNAMODB_REVIEW_CACHE_TABLE"]
+    unique_keys = list(dict.fromkeys(keys))
+    cached = {}
+    now = time.time()
+    # A batch get takes at most 100 keys
+    for start in range(0, len(unique_keys), 100):
+        request = {
+            table: {
+                "Keys": [
+                    {"file_id": {"S": file_id}, "cache_key": {"S": key}}
+                    for key in unique_keys[start : start + 100]
+                ]
+            }
+        }
+        attempt = 0
+        while request:
+            response = dynamodb_client.batch_get_item(RequestItems=request)
+            for item in response["Responses"].get(table, []):
+                # DynamoDB deletes expired items lazily
+                if int(item["expires_at"]["N"]) > now:
+                    cached[item["cache_key"]["S"]] = item["review"]["S"]
+            request = response.get("UnprocessedKeys")
+            if request:
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+
+    hits = sum(key in cached for key in keys)
+    log_metrics(
+        {"ReviewCacheHits": hits, "ReviewCacheMisses": len(keys) - hits}
+    )
+    return cached
+
+
+def put_cached_reviews(file_id, reviews):
+    """
+    Add reviews to the review cache.
+
+    Args:
+        file_id (str): ID of the file.
+        reviews (dict): JSON text of the review of each cache key.
+    """
+    table = os.environ["DYNAMODB_REVIEW_CACHE_TABLE"]
+    expires_at = str(int(time.time()) + REVIEW_CACHE_TTL_SECONDS)
+    requests = [
+        {
+            "PutRequest": {
+                "Item": {
+                    "file_id": {"S": file_id},
+                    "cache_key": {"S": key},
+                    "review": {"S": review},
+                    "expires_at": {"N": expires_at},
+                }
+            }
+        }
+        for key, review in reviews.items()
+    ]
+    # A batch write takes at most 25 items
+    for start in range(0, len(requests), 25):
+        pending = {table: requests[start : start + 25]}
+        attempt = 0
+        while pending:
+            response = dynamodb_client.batch_write_item(RequestItems=pending)
+            pending = response.get("UnprocessedItems")
+            if pending:
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+
+
+def review_sections(file_id, load_original, sections):
+    """
+    Review sections in batches of REVIEW_BATCH_SIZE.
+
+    Sections found in the review cache are not sent to the model, and the
+    contract is only fetched when some are not.
+
+    Args:
+        file_id (str): ID of the file.
+        load_original (callable): Returns the full contract.
+        sections (list): Texts of the sections.
+
+    Returns:
+        dict: The review of each section, and the token usage summed over
+        the batches with the input tokens saved over per-section calls.
+    """
+    keys = [cache_key(section, "batch") for section in sections]
+    cached = get_cached_reviews(file_id, keys)
+    usage = {
+        "model_calls": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "per_section_input_tokens": 0,
+        "cache_hits": sum(key in cached for key in keys),
+    }
+    # Identical sections are only reviewed once
+    missing = list(dict.fromkeys(k for k in keys if k not in cached))
+    if missing:
+        texts = dict(zip(keys, sections))
+        original_text = load_original()
+        for start in range(0, len(missing), REVIEW_BATCH_SIZE):
+            batch = missing[start : start + REVIEW_BATCH_SIZE]
+            batch_reviews, batch_usage = review_batch(
+                original_text, [texts[key] for key in batch]
+            )
+            reviews = {}
+            for key, review in zip(batch, batch_reviews):
+                review.pop("section", None)
+                reviews[key] = json.dumps(review)
+            put_cached_reviews(file_id, reviews)
+            cached.update(reviews)
+            usage["model_calls"] += 1
+            for name, value in batch_usage.items():
+                usage[name] += value
+    usage["saved_input_tokens"] = (
+        usage["per_section_input_tokens"] - usage["input_tokens"]
+    )
+    logger.info(f"Batch review token usage: {json.dumps(usage)}")
+    return {
+        "reviews": [
+            {"section": i, **json.loads(cached[key], strict=False)}
+            for i, key in enumerate(keys)
+        ],
+        "usage": usage,
+    }
+
 
 def lambda_handler(event, context):
     try:
@@ -34,7 +508,18 @@ def lambda_handler(event, context):
         body = json.loads(event["body"])
         # Get the file ID from the query parameters
         file_id = body["id"]
-        review_query = body["review"]
+        # Batch mode reviews a list of sections instead of one
+        sections = body.get("sections")
+        if sections is not None and len(sections) > MAX_SYNC_SECTIONS:
+            return {
+                "statusCode": 400,
+                "body": json.dumps(
+                    f"A batch request reviews at most {MAX_SYNC_SECTIONS} "
+                    "sections, use the review_job endpoint to review the "
+                    "whole file"
+                ),
+            }
+        review_query = body.get("review")
         logging.debug(f"Processing file ID: {file_id}")
         logging.debug(f"Review query: {review_query}")
 
@@ -48,24 +533,36 @@ def lambda_handler(event, context):
             raise ValueError("File metadata not found")
 
         metadata = response["Item"]
-        s3_bucket = os.environ["S3_BUCKET"]
-        original_key = metadata["original_file"]["S"]
 
-        # Fetch the original text file from S3
-        s3_response = s3_client.get_object(Bucket=s3_bucket, Key=original_key)
-        original_text = s3_response["Body"].read().decode("utf-8")
-        logging.debug(original_text[:100])
+        def load_original():
+            # Fetch the original text file from S3
+            s3_response = s3_client.get_object(
+                Bucket=os.environ["S3_BUCKET"],
+                Key=metadata["original_file"]["S"],
+            )
+            original_text = s3_response["Body"].read().decode("utf-8")
+            logging.debug(original_text[:100])
+            return original_text
 
-        initial_prompt = f"""
-        I will first provide you with the full contract for context. Please
-        acknowledge only with a yes or no it you would like to proceed.
-        The next message will contain a section from the contract for review.
-        Please provide your feedback in json format.
+        if sections is not None:
+            result = review_sections(
+                file_id, load_original, load_sections(metadata, sections)
+            )
+            return {
+                "statusCode": 200,
+                "body": json.dumps(result),
+            }
 
-        The full contract is as follows:
-        --------------------------------
-        {original_text}
-        """
+        key = cache_key(review_query, "single")
+        cached = get_cached_reviews(file_id, [key])
+        if key in cached:
+            return {
+                "statusCode": 200,
+                "headers": {"X-Cache": "HIT"},
+                "body": cached[key],
+            }
+
+        initial_prompt = context_prompt(load_original())
 
         review_prompt = f"""
         I will now provide you with a section from the contract for review.
@@ -73,49 +570,19 @@ def lambda_handler(event, context):
         {review_query}
         """
 
-        request = {
-            "modelId": "anthropic.claude-3-opus-20240229-v1:0",
-            "contentType": "application/json",
-            "accept": "application/json",
-            "body": json.dumps(
-                {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 1000,
-                    "system": SYSTEM_PROMPT,
-                    "messages": [
-                        {"role": "user", "content": initial_prompt},
-                        {"role": "assistant", "content": "yes"},
-                        {"role": "user", "content": review_prompt},
-                    ],
-                }
-            ),
-        }
-
-        s3_bucket = os.environ["S3_BUCKET"]
+        messages = [
+            {"role": "user", "content": initial_prompt},
+            {"role": "assistant", "content": "yes"},
+            {"role": "user", "content": review_prompt},
+        ]
 
-        for i in range(3):
-            resp = bedrock_client.invoke_model(**request)
-            resp_json = json.loads(resp["body"].read())
-            review = resp_json["content"][-1]["text"]
-
-            try:
-                json.loads(review, strict=False)
-                logger.debug(f"Review response: {review}")
-                break
-            except Exception as e:
-                logger.warning(
-                    f"Failed to parse response as JSON: {review} on "
-                    f"attempt {i}"
-                )
-                logger.warning(f"Error: {str(e)} encountered, retrying...")
-                if i == 2:
-                    logger.error(
-                        "Failed to parse response as JSON after 3 attempts"
-                    )
-                    raise ValueError("Failed to parse response as JSON")
+        review, _ = invoke_with_retries(messages, parse_review)
+        logger.debug(f"Review response: {review}")
+        put_cached_reviews(file_id, {key: review})
 
         return {
             "statusCode": 200,
+            "headers": {"X-Cache": "MISS"},
             "body": review,
         }
 
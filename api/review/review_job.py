@@ -0,0 +1,430 @@
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+import lambda_function as review
+
+logger = logging.getLogger()
+
+lambda_client = boto3.client("lambda")
+
+# Number of batches of sections reviewed at the same time by a job
+JOB_CONCURRENCY = int(os.environ.get("REVIEW_JOB_CONCURRENCY", 4))
+# A job stops starting batches when the invocation has less time left than
+# the longest a batch can take, and continues in a new invocation
+JOB_TIME_MARGIN_SECONDS = review.MAX_RETRIES_SECONDS
+# Sections of a failed batch are reviewed again, until they failed this
+# many times
+JOB_BATCH_ATTEMPTS = int(os.environ.get("REVIEW_JOB_BATCH_ATTEMPTS", 3))
+JOB_TTL_SECONDS = int(os.environ.get("REVIEW_JOB_TTL_DAYS", 7)) * 24 * 3600
+META_ITEM = "meta"
+FINAL_STATUSES = ("DONE", "PARTIAL", "FAILED")
+
+
+def section_item(section):
+    return f"section#{section:06d}"
+
+
+def load_file(file_id):
+    """
+    Fetch the contract and its sentences.
+
+    Args:
+        file_id (str): ID of the uploaded file.
+
+    Returns:
+        tuple: The text of the contract, and its sentences.
+    """
+    response = review.dynamodb_client.get_item(
+        TableName=os.environ["DYNAMODB_FILE_TABLE"],
+        Key={"file_id": {"S": file_id}},
+    )
+    if "Item" not in response:
+        raise ValueError("File metadata not found")
+
+    metadata = response["Item"]
+    s3_bucket = os.environ["S3_BUCKET"]
+    s3_response = review.s3_client.get_object(
+        Bucket=s3_bucket, Key=metadata["original_file"]["S"]
+    )
+    original_text = s3_response["Body"].read().decode("utf-8")
+    s3_response = review.s3_client.get_object(
+        Bucket=s3_bucket, Key=metadata["structured_file"]["S"]
+    )
+    segments = json.loads(s3_response["Body"].read())["segments"]
+    return original_text, segments
+
+
+def start_job(file_id, function_name):
+    """
+    Create a review job for a file and start it in the background.
+
+    Args:
+        file_id (str): ID of the uploaded file.
+        function_name (str): Name of the Lambda function running the job.
+
+    Returns:
+        str: ID of the job.
+    """
+    _, segments = load_file(file_id)
+    job_id = str(uuid.uuid4())
+    now = int(time.time())
+    review.dynamodb_client.put_item(
+        TableName=os.environ["DYNAMODB_JOB_TABLE"],
+        Item={
+            "job_id": {"S": job_id},
+            "item": {"S": META_ITEM},
+            "file_id": {"S": file_id},
+            "status": {"S": "PENDING"},
+            "total_sections": {"N": str(len(segments))},
+            "completed_sections": {"N": "0"},
+            "failed_sections": {"N": "0"},
+            "updated_at": {"N": str(now)},
+            "expires_at": {"N": str(now + JOB_TTL_SECONDS)},
+        },
+    )
+    invoke_job(job_id, function_name)
+    return job_id
+
+
+def invoke_job(job_id, function_name):
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps({"job_id": job_id}),
+    )
+
+
+def query_job(job_id):
+    """
+    Fetch every item of a job.
+
+    Args:
+        job_id (str): ID of the job.
+
+    Returns:
+        list: The DynamoDB items of the job, the meta item first.
+    """
+    items = []
+    kwargs = {
+        "TableName": os.environ["DYNAMODB_JOB_TABLE"],
+        "KeyConditionExpression": "job_id = :job_id",
+        "ExpressionAttributeValues": {":job_id": {"S": job_id}},
+    }
+    while True:
+        response = review.dynamodb_client.query(**kwargs)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    # "meta" sorts after the "section#" items
+    return sorted(items, key=lambda item: item["item"]["S"] != META_ITEM)
+
+
+def update_job(job_id, status, **counts):
+    expression = "SET #status = :status, updated_at = :now"
+    values = {
+        ":status": {"S": status},
+        ":now": {"N": str(int(time.time()))},
+    }
+    if counts:
+        expression += " ADD " + ", ".join(f"{name} :{name}" for name in counts)
+        values.update(
+            {f":{name}": {"N": str(count)} for name, count in counts.items()}
+        )
+    review.dynamodb_client.update_item(
+        TableName=os.environ["DYNAMODB_JOB_TABLE"],
+        Key={"job_id": {"S": job_id}, "item": {"S": META_ITEM}},
+        UpdateExpression=expression,
+        ExpressionAttributeNames={"#status": "status"},
+        ExpressionAttributeValues=values,
+    )
+
+
+def save_results(job_id, sections, attempts, reviews=None, error=None):
+    """
+    Store the reviews of a batch, or the error that made it fail.
+
+    Args:
+        job_id (str): ID of the job.
+        sections (list): Indexes of the sections of the batch.
+        attempts (dict): Number of failed reviews of each section that
+            failed, including this batch when it failed.
+        reviews (list): Review of each section.
+        error (str): Error of the batch, when it failed.
+    """
+    expires_at = str(int(time.time()) + JOB_TTL_SECONDS)
+    requests = []
+    for i, section in enumerate(sections):
+        item = {
+            "job_id": {"S": job_id},
+            "item": {"S": section_item(section)},
+            "section": {"N": str(section)},
+            "expires_at": {"N": expires_at},
+        }
+        if error is None:
+            item["review"] = {"S": json.dumps(reviews[i])}
+        else:
+            item["error"] = {"S": error}
+            item["attempts"] = {"N": str(attempts[section])}
+        requests.append({"PutRequest": {"Item": item}})
+
+    table = os.environ["DYNAMODB_JOB_TABLE"]
+    # A batch write takes at most 25 items
+    for start in range(0, len(requests), 25):
+        pending = {table: requests[start : start + 25]}
+        attempt = 0
+        while pending:
+            response = review.dynamodb_client.batch_write_item(
+                RequestItems=pending
+            )
+            pending = response.get("UnprocessedItems")
+            if pending:
+                time.sleep(review.backoff_delay(attempt))
+                attempt += 1
+
+    # failed_sections counts the sections whose last review failed
+    if error is None:
+        counts = {"completed_sections": len(sections)}
+        retried = sum(section in attempts for section in sections)
+        if retried:
+            counts["failed_sections"] = -retried
+    else:
+        counts = {
+            "failed_sections": sum(
+                attempts[section] == 1 for section in sections
+            )
+        }
+    update_job(job_id, "RUNNING", **counts)
+
+
+def finish_job(job_id):
+    """
+    Set the final status of a job from its counts.
+
+    Args:
+        job_id (str): ID of the job.
+
+    Returns:
+        str: DONE when every section was reviewed, FAILED when none was,
+        and PARTIAL otherwise.
+    """
+    meta = review.dynamodb_client.get_item(
+        TableName=os.environ["DYNAMODB_JOB_TABLE"],
+        Key={"job_id": {"S": job_id}, "item": {"S": META_ITEM}},
+        ConsistentRead=True,
+    )["Item"]
+    if int(meta["failed_sections"]["N"]) == 0:
+        status = "DONE"
+    elif int(meta["completed_sections"]["N"]) == 0:
+        status = "FAILED"
+    else:
+        status = "PARTIAL"
+    update_job(job_id, status)
+    return status
+
+
+def run_job(job_id, client=None, remaining_seconds=None, function_name=None):
+    """
+    Review the sections of a job that have no result yet.
+
+    Batches of REVIEW_BATCH_SIZE sections are reviewed JOB_CONCURRENCY at a
+    time, and their results are stored as they complete, so that a job
+    that runs out of time continues where it stopped. The sections of a
+    failed batch are reviewed again in later batches, until they failed
+    JOB_BATCH_ATTEMPTS times. Reviews are shared with batch requests
+    through the review cache.
+
+    Args:
+        job_id (str): ID of the job.
+        client: Bedrock runtime client, defaults to bedrock_client.
+        remaining_seconds (callable): Returns the time left to this
+            invocation, or None to run the job to the end.
+        function_name (str): Name of the Lambda function to continue the
+            job in when this invocation runs out of time.
+
+    Returns:
+        str: The status of the job, or None if the job does not exist.
+    """
+    items = query_job(job_id)
+    if not items or items[0]["item"]["S"] != META_ITEM:
+        logger.error(f"Review job {job_id} not found")
+        return None
+    meta = items[0]
+    if meta["status"]["S"] in FINAL_STATUSES:
+        return meta["status"]["S"]
+
+    file_id = meta["file_id"]["S"]
+    try:
+        original_text, segments = load_file(file_id)
+    except Exception as e:
+        logger.error(f"Failed to load the file of job {job_id}: {str(e)}")
+        update_job(job_id, "FAILED")
+        return "FAILED"
+
+    attempts = {}
+    done = set()
+    for item in items[1:]:
+        section = int(item["section"]["N"])
+        if "error" in item:
+            attempts[section] = int(item["attempts"]["N"])
+        if "review" in item or attempts[section] >= JOB_BATCH_ATTEMPTS:
+            done.add(section)
+    pending = [i for i in range(len(segments)) if i not in done]
+
+    # Sections reviewed before, by a job or a batch request on the same
+    # file, are taken from the review cache
+    keys = {i: review.cache_key(segments[i], "batch") for i in pending}
+    cached = review.get_cached_reviews(file_id, list(keys.values()))
+    hits = [i for i in pending if keys[i] in cached]
+    if hits:
+        save_results(
+            job_id,
+            hits,
+            attempts,
+            [json.loads(cached[keys[i]], strict=False) for i in hits],
+        )
+    pending = [i for i in pending if keys[i] not in cached]
+    batches = [
+        pending[start : start + review.REVIEW_BATCH_SIZE]
+        for start in range(0, len(pending), review.REVIEW_BATCH_SIZE)
+    ]
+    update_job(job_id, "RUNNING")
+    logger.info(f"Job {job_id}: {len(batches)} batches left")
+
+    def review_and_save(sections):
+        # Returns the sections to review again
+        try:
+            reviews, _ = review.review_batch(
+                original_text, [segments[i] for i in sections], client
+            )
+        except Exception as e:
+            logger.error(f"Job {job_id}: batch {sections} failed: {str(e)}")
+            # A batch only runs once at a time, so sections are not shared
+            for section in sections:
+                attempts[section] = attempts.get(section, 0) + 1
+            save_results(job_id, sections, attempts, error=str(e))
+            return [s for s in sections if attempts[s] < JOB_BATCH_ATTEMPTS]
+        for result in reviews:
+            result.pop("section", None)
+        save_results(job_id, sections, attempts, reviews)
+        try:
+            review.put_cached_reviews(
+                file_id,
+                {
+                    keys[section]: json.dumps(result)
+                    for section, result in zip(sections, reviews)
+                },
+            )
+        except Exception as e:
+            # The reviews are saved to the job, only later requests miss them
+            logger.warning(f"Job {job_id}: failed to cache reviews: {str(e)}")
+        return []
+
+    started = 0
+    with ThreadPoolExecutor(max_workers=JOB_CONCURRENCY) as executor:
+        running = set()
+        while batches or running:
+            if (
+                batches
+                and len(running) < JOB_CONCURRENCY
+                and (
+                    remaining_seconds is None
+                    or remaining_seconds() >= JOB_TIME_MARGIN_SECONDS
+                )
+            ):
+                running.add(executor.submit(review_and_save, batches.pop(0)))
+                started += 1
+                continue
+            if not running:
+                break
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                retry = future.result()
+                if retry:
+                    batches.append(retry)
+
+    if batches:
+        if not started:
+            # Continuing would never start a batch either
+            logger.error(
+                f"Job {job_id}: the invocation has less than "
+                f"{JOB_TIME_MARGIN_SECONDS}s to review a batch"
+            )
+            update_job(job_id, "FAILED")
+            return "FAILED"
+        logger.info(f"Job {job_id}: continuing in a new invocation")
+        invoke_job(job_id, function_name)
+        return "RUNNING"
+    return finish_job(job_id)
+
+
+def job_status(job_id):
+    """
+    Summarise the progress and results of a job.
+
+    Args:
+        job_id (str): ID of the job.
+
+    Returns:
+        dict: The status and counts of the job, with the review or error
+        of each completed section, or None if the job does not exist.
+    """
+    items = query_job(job_id)
+    if not items or items[0]["item"]["S"] != META_ITEM:
+        return None
+    meta = items[0]
+    results = []
+    for item in items[1:]:
+        result = {"section": int(item["section"]["N"])}
+        if "review" in item:
+            result["review"] = json.loads(item["review"]["S"], strict=False)
+        else:
+            result["error"] = item["error"]["S"]
+        results.append(result)
+    return {
+        "job_id": job_id,
+        "file_id": meta["file_id"]["S"],
+        "status": meta["status"]["S"],
+        "total_sections": int(meta["total_sections"]["N"]),
+        "completed_sections": int(meta["completed_sections"]["N"]),
+        "failed_sections": int(meta["failed_sections"]["N"]),
+        "results": results,
+    }
+
+
+def lambda_handler(event, context):
+    # Invoked by start_job or by a job continuing itself
+    if "httpMethod" not in event:
+        return run_job(
+            event["job_id"],
+            remaining_seconds=lambda: (
+                context.get_remaining_time_in_millis() / 1000
+            ),
+            function_name=context.function_name,
+        )
+
+    try:
+        if event["httpMethod"] == "GET":
+            params = event.get("queryStringParameters") or {}
+            status = job_status(params["job_id"])
+            if status is None:
+                return {
+                    "statusCode": 404,
+                    "body": json.dumps("Review job not found"),
+                }
+            return {"statusCode": 200, "body": json.dumps(status)}
+
+        body = json.loads(event["body"])
+        job_id = start_job(body["id"], context.function_name)
+        return {"statusCode": 202, "body": json.dumps({"job_id": job_id})}
+
+    except Exception as e:
+        return {
+            "statusCode": 500,
+            "body": json.dumps(f"Error processing review job: {str(e)}"),
+        }
@@ -1,18 +1,169 @@
 import base64
+import hashlib
 import json
 import logging
 import os
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import nltk
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from nltk.tokenize.punkt import PunktSentenceTokenizer
 
 logger = logging.getLogger()
 
-s3_client = boto3.client("s3")
-dynamodb_client = boto3.client("dynamodb")
-sagemaker_client = boto3.client("sagemaker-runtime")
+# Clients and threads are created once per container and reused by warm
+# invocations, with keep-alive connections so that the overlapping calls do
+# not each pay for a new TLS handshake
+client_config = Config(
+    max_pool_connections=int(os.environ.get("MAX_POOL_CONNECTIONS", 10)),
+    tcp_keepalive=True,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
+s3_client = boto3.client("s3", config=client_config)
+dynamodb_client = boto3.client("dynamodb", config=client_config)
+sagemaker_client = boto3.client("sagemaker-runtime", config=client_config)
+sagemaker_control_client = boto3.client("sagemaker", config=client_config)
+executor = ThreadPoolExecutor(max_workers=2)
+
+# Uploads are deduplicated per endpoint config, which changes whenever a new
+# model is deployed, and the config is looked up again after this many
+# seconds
+MODEL_VERSION_TTL_SECONDS = int(os.environ.get("MODEL_VERSION_TTL", 60))
+model_version_cache = {"version": None, "expires_at": 0.0}
+DEDUP_TTL_SECONDS = int(os.environ.get("DEDUP_TTL_DAYS", 30)) * 24 * 3600
+
+
+def timed(timings, name, function, *args, **kwargs):
+    """
+    Call a function and record how long it took.
+
+    Args:
+        timings (dict): Durations in milliseconds, updated with this call.
+        name (str): Name of the step.
+        function (callable): Function to call.
+
+    Returns:
+        The return value of the function.
+    """
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1e3, 1)
+
+
+def current_model_version():
+    """
+    Identify the model deployed behind the endpoint.
+
+    SageMaker endpoint configs are immutable, so a new model artifact is
+    always deployed with a new endpoint config.
+
+    Returns:
+        str: The name of the endpoint config the endpoint runs.
+    """
+    now = time.time()
+    if now >= model_version_cache["expires_at"]:
+        response = sagemaker_control_client.describe_endpoint(
+            EndpointName=os.environ["MODEL_ENDPOINT_NAME"]
+        )
+        model_version_cache["version"] = response["EndpointConfigName"]
+        model_version_cache["expires_at"] = now + MODEL_VERSION_TTL_SECONDS
+    return model_version_cache["version"]
+
+
+def lookup_upload(content_hash, model_version):
+    """
+    Find a previous upload of the same document.
+
+    Args:
+        content_hash (str): SHA-256 hex digest of the document.
+        model_version (str): Version from current_model_version.
+
+    Returns:
+        dict: The DynamoDB item of the upload, or None if the document was
+        not uploaded with the current model version or its entry expired.
+    """
+    response = dynamodb_client.get_item(
+        TableName=os.environ["DYNAMODB_DEDUP_TABLE"],
+        Key={
+            "content_hash": {"S": content_hash},
+            "model_version": {"S": model_version},
+        },
+    )
+    item = response.get("Item")
+    # DynamoDB deletes expired items lazily, so they are checked here too
+    if item is None or int(item["expires_at"]["N"]) <= time.time():
+        return None
+    return item
+
+
+def save_upload(content_hash, model_version, orig_key, structured_key):
+    """
+    Add an upload to the deduplication table.
+
+    Args:
+        content_hash (str): SHA-256 hex digest of the document.
+        model_version (str): Version from current_model_version.
+        orig_key (str): S3 key of the original text file.
+        structured_key (str): S3 key of the structured json file.
+    """
+    dynamodb_client.put_item(
+        TableName=os.environ["DYNAMODB_DEDUP_TABLE"],
+        Item={
+            "content_hash": {"S": content_hash},
+            "model_version": {"S": model_version},
+            "original_file": {"S": orig_key},
+            "structured_file": {"S": structured_key},
+            "expires_at": {"N": str(int(time.time()) + DEDUP_TTL_SECONDS)},
+        },
+    )
+
+
+def save_structured(
+    timings,
+    body,
+    s3_bucket,
+    orig_key,
+    structured_key,
+    content_hash,
+    model_version,
+):
+    """
+    Save the structured json file to S3 and add the upload to the
+    deduplication table.
+
+    Args:
+        timings (dict): Durations in milliseconds, updated with both steps.
+        body (dict): Response of the model endpoint.
+        s3_bucket (str): S3 bucket of the files.
+        orig_key (str): S3 key of the original text file.
+        structured_key (str): S3 key of the structured json file.
+        content_hash (str): SHA-256 hex digest of the document.
+        model_version (str): Version from current_model_version.
+    """
+    timed(
+        timings,
+        "put_structured",
+        s3_client.put_object,
+        Bucket=s3_bucket,
+        Key=structured_key,
+        Body=json.dumps(body),
+    )
+    # Only files that were written are added to the table
+    timed(
+        timings,
+        "save_dedup",
+        save_upload,
+        content_hash,
+        model_version,
+        orig_key,
+        structured_key,
+    )
 
 
 def lambda_handler(event, context):
@@ -30,49 +181,114 @@ def lambda_handler(event, context):
             file_content = body
 
         logger.info(f"Received file with {len(file_content)} characters.")
+        if isinstance(file_content, str):
+            file_content = file_content.encode("utf-8")
+        start = time.perf_counter()
+        timings = {}
 
         # Generate a unique file ID
         file_id = str(uuid.uuid4())
 
         # Define S3 bucket and file name
         s3_bucket = os.environ["S3_BUCKET"]
-        orig_key = f"uploads/{file_id}.txt"
-        structured_key = f"processed/{file_id}.json"
+        content_hash = hashlib.sha256(file_content).hexdigest()
+        model_version = timed(timings, "model_version", current_model_version)
+        cached = timed(
+            timings, "lookup_dedup", lookup_upload, content_hash, model_version
+        )
+        structured_upload = None
 
-        # Save the original text file to S3
-        s3_client.put_object(Bucket=s3_bucket, Key=orig_key, Body=file_content)
+        if cached is not None:
+            # The same document was segmented by the same model before, the
+            # new file ID points to its files
+            orig_key = cached["original_file"]["S"]
+            structured_key = cached["structured_file"]["S"]
+            logger.info(f"Reusing {structured_key} for hash {content_hash}.")
+            try:
+                response = timed(
+                    timings,
+                    "get_structured",
+                    s3_client.get_object,
+                    Bucket=s3_bucket,
+                    Key=structured_key,
+                )
+                body = json.loads(response["Body"].read().decode())
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                    raise
+                # The files were deleted since, the document is segmented
+                # again and the entry is replaced
+                logger.warning(f"{structured_key} is gone, segmenting again.")
+                cached = None
 
-        response = sagemaker_client.invoke_endpoint(
-            EndpointName=os.environ["MODEL_ENDPOINT_NAME"],
-            ContentType="text/plain",
-            Body=bytes(file_content, "utf-8"),
-        )
+        if cached is None:
+            orig_key = f"uploads/{file_id}.txt"
+            structured_key = f"processed/{file_id}.json"
+
+            # Save the original text file to S3 while the model segments it
+            orig_upload = executor.submit(
+                timed,
+                timings,
+                "put_original",
+                s3_client.put_object,
+                Bucket=s3_bucket,
+                Key=orig_key,
+                Body=file_content,
+            )
+            try:
+                response = timed(
+                    timings,
+                    "invoke_endpoint",
+                    sagemaker_client.invoke_endpoint,
+                    EndpointName=os.environ["MODEL_ENDPOINT_NAME"],
+                    ContentType="text/plain",
+                    Body=file_content,
+                )
+                body = json.loads(response["Body"].read().decode())
+            finally:
+                orig_upload.result()
+
+            # Save the structured json file to S3 while adding an entry to
+            # DynamoDB, the entry only points to the file
+            structured_upload = executor.submit(
+                save_structured,
+                timings,
+                body,
+                s3_bucket,
+                orig_key,
+                structured_key,
+                content_hash,
+                model_version,
+            )
 
-        body = json.loads(response["Body"].read().decode())
         segmented_text = body["segments"]
         sentence_ends = body["ends"]
 
         logger.info(f"Segmented text into {len(segmented_text)} sentences.")
         logger.info(f"First three sentences: {segmented_text[:3]}")
 
-        # Save the structured json file to S3
-        s3_client.put_object(
-            Bucket=s3_bucket, Key=structured_key, Body=json.dumps(body)
-        )
-
-        # Add an entry to DynamoDB
         dynamodb_table = os.environ["DYNAMODB_FILE_TABLE"]
         dynamo_entry = {
             "file_id": {"S": file_id},
             "original_file": {"S": orig_key},
             "structured_file": {"S": structured_key},
         }
-        dynamodb_client.put_item(
-            TableName=dynamodb_table,
-            Item=dynamo_entry,
-        )
+        try:
+            timed(
+                timings,
+                "put_metadata",
+                dynamodb_client.put_item,
+                TableName=dynamodb_table,
+                Item=dynamo_entry,
+            )
+        finally:
+            if structured_upload is not None:
+                structured_upload.result()
         logger.debug(f"Added entry to DynamoDB: {dynamo_entry}")
 
+        timings["total"] = round((time.perf_counter() - start) * 1e3, 1)
+        logger.info(f"Step timings in ms: {json.dumps(timings)}")
+
         return {
             "statusCode": 200,
             "body": json.dumps(
@@ -51,7 +51,8 @@ resource "aws_api_gateway_integration" "gateway_integrations" {
   resource_id             = aws_api_gateway_resource.gateway_resources[each.key].id
   http_method             = aws_api_gateway_method.gateway_methods[each.key].http_method
   type                    = "AWS_PROXY"
-  integration_http_method = each.value.method
+  // Lambda is always invoked with POST, whatever the method of the request
+  integration_http_method = "POST"
   uri                     = aws_lambda_function.lambda_functions[each.key].invoke_arn
 }
 
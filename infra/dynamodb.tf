@@ -10,3 +10,75 @@ resource "aws_dynamodb_table" "file_metadata" {
 
   tags = var.tags
 }
+
+resource "aws_dynamodb_table" "upload_dedup" {
+  name         = "upload_dedup"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "content_hash"
+  range_key    = "model_version"
+
+  attribute {
+    name = "content_hash"
+    type = "S"
+  }
+
+  attribute {
+    name = "model_version"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = var.tags
+}
+
+resource "aws_dynamodb_table" "review_jobs" {
+  name         = "review_jobs"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "job_id"
+  range_key    = "item"
+
+  attribute {
+    name = "job_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "item"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = var.tags
+}
+
+resource "aws_dynamodb_table" "review_cache" {
+  name         = "review_cache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "file_id"
+  range_key    = "cache_key"
+
+  attribute {
+    name = "file_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = var.tags
+}
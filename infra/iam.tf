@@ -24,3 +24,37 @@ resource "aws_iam_role" "lambda_role" {
 
   tags = var.tags
 }
+
+// Review jobs run and continue themselves in background invocations
+resource "aws_iam_role_policy" "lambda_invoke_self" {
+  name = "lambda_invoke_review_job"
+  role = aws_iam_role.lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action   = "lambda:InvokeFunction"
+        Effect   = "Allow"
+        Resource = aws_lambda_function.lambda_functions["review_job"].arn
+      },
+    ]
+  })
+}
+
+// Uploads are deduplicated per endpoint config of the model endpoint
+resource "aws_iam_role_policy" "lambda_describe_endpoint" {
+  name = "lambda_describe_model_endpoint"
+  role = aws_iam_role.lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Action   = "sagemaker:DescribeEndpoint"
+        Effect   = "Allow"
+        Resource = "arn:aws:sagemaker:*:*:endpoint/${var.model_endpoint_name}"
+      },
+    ]
+  })
+}
@@ -3,9 +3,9 @@ resource "aws_lambda_function" "lambda_functions" {
   filename      = each.value.package_file
   function_name = each.value.function_name
   role          = aws_iam_role.lambda_role.arn
-  handler       = "lambda_function.lambda_handler"
+  handler       = each.value.handler
   runtime       = "python3.12"
-  timeout       = 120
+  timeout       = each.value.timeout
   memory_size   = 128
 
   source_code_hash = filebase64sha256(each.value.package_file)
@@ -15,6 +15,10 @@ resource "aws_lambda_function" "lambda_functions" {
       S3_BUCKET      = aws_s3_bucket.file_upload_bucket.bucket
       DYNAMODB_FILE_TABLE = aws_dynamodb_table.file_metadata.name
       MODEL_ENDPOINT_NAME = "legallm-model-endpoint"
+      DYNAMODB_DEDUP_TABLE = aws_dynamodb_table.upload_dedup.name
+      DEDUP_TTL_DAYS = var.dedup_ttl_days
+      DYNAMODB_JOB_TABLE = aws_dynamodb_table.review_jobs.name
+      DYNAMODB_REVIEW_CACHE_TABLE = aws_dynamodb_table.review_cache.name
     }
   }
 
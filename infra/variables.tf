@@ -23,6 +23,8 @@ variable "endpoints" {
     method        = string
     function_name = string
     package_file  = string
+    handler       = optional(string, "lambda_function.lambda_handler")
+    timeout       = optional(number, 120)
   }))
   default = {
     upload = {
@@ -36,6 +38,23 @@ variable "endpoints" {
       method = "POST"
       function_name = "review_function"
       package_file = "../api/review/my_deployment_package.zip"
+    },
+    // Both review job endpoints run review_job.py from the review package,
+    // the job itself runs in background invocations of review_job_function
+    review_job = {
+      path = "review_job"
+      method = "POST"
+      function_name = "review_job_function"
+      package_file = "../api/review/my_deployment_package.zip"
+      handler = "review_job.lambda_handler"
+      timeout = 900
+    },
+    review_job_status = {
+      path = "review_job_status"
+      method = "GET"
+      function_name = "review_job_status_function"
+      package_file = "../api/review/my_deployment_package.zip"
+      handler = "review_job.lambda_handler"
     }
   }
 }
@@ -47,3 +66,7 @@ variable "domain_name" {
 variable "model_endpoint_name" {
   default = "legallm-model-endpoint"
 }
+
+variable "dedup_ttl_days" {
+  default = 30
+}
@@ -0,0 +1,155 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatcher:
+    def __init__(
+        self, score_fn, max_batch_size=4096, max_wait=0.0, context_size=6
+    ):
+        """
+        Coalesce scoring calls from concurrent requests into larger batches.
+
+        Calls to score are queued and a background thread runs them through
+        score_fn together: the token IDs of the queued calls are concatenated
+        and their candidate indexes offset accordingly. Since the first and
+        last context_size tokens of each call are only context, no candidate
+        sees tokens of another call.
+
+        Calls with more than max_batch_size candidates are split into parts
+        that fit in a batch. With a max_wait of 0 no call would wait for
+        others, so calls are scored directly in the calling thread.
+
+        Args:
+            score_fn (callable): Function taking the token IDs and the
+                candidate token indexes, returning the probability of each
+                candidate.
+            max_batch_size (int): Maximum number of candidates in a batch.
+            max_wait (float): Maximum time in seconds to wait for more calls
+                before running a batch that is not full.
+            context_size (int): Number of tokens of context on each side of
+                a candidate.
+        """
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.context_size = context_size
+        self.batches = 0
+        self.requests = 0
+        self.windows = 0
+        self.wait_seconds = 0.0
+        self._queue = queue.Queue()
+        # Call taken from the queue that did not fit in the previous batch
+        self._carry = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def score(self, ids, token_idxes):
+        """
+        Score the candidates of a sequence of token IDs.
+
+        Args:
+            ids (np.ndarray): Token IDs.
+            token_idxes (np.ndarray): Indexes of the candidate tokens.
+
+        Returns:
+            np.ndarray: The probability of each candidate.
+        """
+        if self.max_wait <= 0:
+            probs = self.score_fn(ids, token_idxes)
+            with self._lock:
+                self.batches += 1
+                self.requests += 1
+                self.windows += len(probs)
+            return probs
+
+        self._start()
+        if len(token_idxes) <= self.max_batch_size:
+            parts = [(ids, token_idxes)]
+        else:
+            # Each part only keeps the tokens its candidates see
+            parts = []
+            for start in range(0, len(token_idxes), self.max_batch_size):
+                part_idxes = token_idxes[start : start + self.max_batch_size]
+                first = part_idxes[0] - self.context_size
+                last = part_idxes[-1] + self.context_size + 1
+                parts.append((ids[first:last], part_idxes - first))
+
+        futures = []
+        for part_ids, part_idxes in parts:
+            future = Future()
+            self._queue.put((part_ids, part_idxes, future, time.monotonic()))
+            futures.append(future)
+        if len(futures) == 1:
+            return futures[0].result()
+        return np.concatenate([future.result() for future in futures])
+
+    def _start(self):
+        # The thread is started lazily so that it is created in each worker
+        # process rather than in a parent process that forks them
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        if self._carry is not None:
+            batch = [self._carry]
+            self._carry = None
+        else:
+            batch = [self._queue.get()]
+        num_windows = len(batch[0][1])
+        deadline = time.monotonic() + self.max_wait
+
+        while num_windows < self.max_batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if num_windows + len(item[1]) > self.max_batch_size:
+                self._carry = item
+                break
+            batch.append(item)
+            num_windows += len(item[1])
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.monotonic()
+
+            all_ids = []
+            all_token_idxes = []
+            offset = 0
+            for ids, token_idxes, _, _ in batch:
+                all_ids.append(ids)
+                all_token_idxes.append(token_idxes + offset)
+                offset += len(ids)
+
+            try:
+                probs = self.score_fn(
+                    np.concatenate(all_ids), np.concatenate(all_token_idxes)
+                )
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            splits = np.cumsum([len(item[1]) for item in batch])[:-1]
+            for (_, _, future, _), item_probs in zip(
+                batch, np.split(probs, splits)
+            ):
+                future.set_result(item_probs)
+
+            self.batches += 1
+            self.requests += len(batch)
+            self.windows += len(probs)
+            self.wait_seconds += sum(start - item[3] for item in batch)
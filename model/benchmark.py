@@ -0,0 +1,383 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000, 50_000_000]
+DEFAULT_BACKENDS = ["eager"]
+# Latency regressions larger than this fraction of the baseline fail the run
+DEFAULT_TOLERANCE = 0.1
+# Time budget in seconds of the timed runs of each case, at least
+# MIN_REPEATS and at most MAX_REPEATS runs are timed
+TIME_BUDGET = 10.0
+MIN_REPEATS = 3
+MAX_REPEATS = 50
+
+_PARTIES = ["the Company", "the Licensee", "Acme Holdings, Inc.", "the Buyer"]
+_TERMS = ["Agreement", "Effective Date", "Confidential Information", "Term"]
+_CLAUSES = [
+    "{party} shall not assign this {term} without the prior written consent "
+    "of {other}.",
+    "Pursuant to Section {section}, {party} may terminate this {term} upon "
+    "thirty (30) days' notice to {other}.",
+    'As used herein, "{term}" means the date on which {party} receives the '
+    "payment described in Section {section}(b).",
+    "{party} agrees to indemnify {other} against all claims; provided, "
+    "however, that no claim under 15 U.S.C. § 78 shall be covered.",
+    "Notwithstanding the foregoing, {party} (i) shall comply with all "
+    "applicable laws and (ii) shall maintain insurance of at least "
+    "$1,000,000.00 per occurrence.",
+    "This {term} shall be governed by the laws of the State of New York, "
+    "U.S.A., without regard to its conflict of laws principles.",
+]
+
+
+def generate_document(size, seed=0):
+    """
+    Generate a synthetic legal-style document.
+
+    The document is made of numbered sections of contract clauses, with
+    abbreviations, parenthesised enumerations, quotes and line breaks, so
+    that it has the kinds of candidates found in contracts.
+
+    Args:
+        size (int): Size of the document in bytes, once UTF-8 encoded.
+        seed (int): Seed of the generator, the same seed and size always
+            give the same document.
+
+    Returns:
+        str: The document.
+    """
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    section = 0
+    while length < size:
+        section += 1
+        lines = [f"\n{section}. {rng.choice(_TERMS).upper()}\n"]
+        for letter in "abcd"[: rng.randint(1, 4)]:
+            party, other = rng.sample(_PARTIES, 2)
+            clause = rng.choice(_CLAUSES).format(
+                party=party,
+                other=other,
+                term=rng.choice(_TERMS),
+                section=f"{section}.{rng.randint(1, 9)}",
+            )
+            lines.append(f"({letter}) {clause}\n")
+        part = "".join(lines)
+        parts.append(part)
+        length += len(part)
+    # A character cut in half at the end is dropped
+    return "".join(parts).encode("utf-8")[:size].decode("utf-8", "ignore")
+
+
+def _percentiles(latencies):
+    return {f"p{q}": float(np.percentile(latencies, q)) for q in (50, 95, 99)}
+
+
+def _parse_server_timing(header):
+    stages = {}
+    for metric in header.split(","):
+        name, _, duration = metric.strip().partition(";dur=")
+        if duration:
+            stages[name] = float(duration) / 1e3
+    return stages
+
+
+def _count_windows(document):
+    # Counted by the model served in this process, which is assumed to be
+    # the one behind the benchmarked URL
+    import inference
+
+    # The candidates of a request are recorded when its response is closed
+    client = inference.app.test_client()
+    before = inference.request_candidates.sum()
+    client.post("/invocations", data=document.encode("utf-8")).close()
+    return round(inference.request_candidates.sum() - before)
+
+
+def _time_case(post, document):
+    """
+    Time repeated requests on a document.
+
+    Args:
+        post (callable): Function sending the document and returning the
+            Server-Timing header of the response.
+        document (str): The document.
+
+    Returns:
+        tuple: The latency of each run, and the stage durations of each
+        run.
+    """
+    post(document)
+    latencies = []
+    stages = []
+    start = time.perf_counter()
+    while len(latencies) < MIN_REPEATS or (
+        len(latencies) < MAX_REPEATS
+        and time.perf_counter() - start < TIME_BUDGET
+    ):
+        run_start = time.perf_counter()
+        server_timing = post(document)
+        latencies.append(time.perf_counter() - run_start)
+        stages.append(_parse_server_timing(server_timing or ""))
+    return latencies, stages
+
+
+def _summarise(target, backend, document, windows, latencies, stages):
+    size = len(document.encode("utf-8"))
+    mean = float(np.mean(latencies))
+    stage_names = sorted({name for run in stages for name in run})
+    return {
+        "target": target,
+        "backend": backend,
+        "size": size,
+        "runs": len(latencies),
+        **_percentiles(latencies),
+        "mb_per_s": size / 1e6 / mean,
+        "windows_per_s": windows / mean,
+        "stages": {
+            name: _percentiles([run.get(name, 0.0) for run in stages])
+            for name in stage_names
+        },
+        # Linux reports the maximum resident set size in kilobytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / 1024,
+    }
+
+
+def run_in_process(backend, size, seed):
+    """
+    Benchmark the /invocations pipeline of a backend in this process.
+
+    Args:
+        backend (str): Model backend, see backends.load_scorer.
+        size (int): Size of the document in bytes.
+        seed (int): Seed of the document.
+
+    Returns:
+        dict: Latency percentiles, throughput, stage durations and peak RSS.
+    """
+    os.environ["MODEL_BACKEND"] = backend
+    import inference
+
+    client = inference.app.test_client()
+    document = generate_document(size, seed)
+
+    def post(document):
+        response = client.post("/invocations", data=document.encode("utf-8"))
+        response.close()
+        return response.headers.get("Server-Timing")
+
+    # Every run, and the warm up run, scores the same candidates
+    before = inference.request_candidates.sum()
+    latencies, stages = _time_case(post, document)
+    windows = (inference.request_candidates.sum() - before) / (
+        len(latencies) + 1
+    )
+    return _summarise(
+        "in-process", backend, document, windows, latencies, stages
+    )
+
+
+def run_http(url, size, seed):
+    """
+    Benchmark a running model server over HTTP.
+
+    Args:
+        url (str): Base URL of the server, e.g. http://localhost:8080.
+        size (int): Size of the document in bytes.
+        seed (int): Seed of the document.
+
+    Returns:
+        dict: Latency percentiles, throughput and stage durations. The peak
+        RSS is that of the client, the server's is on its host.
+    """
+    document = generate_document(size, seed)
+
+    def post(document):
+        request = urllib.request.Request(
+            f"{url}/invocations",
+            data=document.encode("utf-8"),
+            headers={"Content-Type": "text/plain"},
+        )
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.headers.get("Server-Timing")
+
+    latencies, stages = _time_case(post, document)
+    return _summarise(
+        "http", "server", document, _count_windows(document), latencies, stages
+    )
+
+
+def run_pysbd(size, seed):
+    """
+    Benchmark pySBD on the same document, for reference.
+
+    Args:
+        size (int): Size of the document in bytes.
+        seed (int): Seed of the document.
+
+    Returns:
+        dict: Latency percentiles and throughput, or None if pySBD is not
+        installed.
+    """
+    try:
+        import pysbd
+    except ImportError:
+        return None
+
+    segmenter = pysbd.Segmenter(language="en", clean=False)
+    document = generate_document(size, seed)
+
+    def post(document):
+        segmenter.segment(document)
+
+    latencies, stages = _time_case(post, document)
+    return _summarise("pysbd", "pysbd", document, 0, latencies, stages)
+
+
+def _run_isolated(function, *args):
+    # Each case runs in a fresh process, so that its peak RSS is its own
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return executor.submit(function, *args).result()
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Find the cases whose median latency regressed against a baseline.
+
+    Args:
+        results (list): Results of this run.
+        baseline (list): Results of a previous run.
+        tolerance (float): Allowed slowdown, as a fraction of the baseline.
+
+    Returns:
+        list: One message per regressed case.
+    """
+    previous = {
+        (result["target"], result["backend"], result["size"]): result
+        for result in baseline
+    }
+    regressions = []
+    for result in results:
+        key = (result["target"], result["backend"], result["size"])
+        if key not in previous:
+            continue
+        before, after = previous[key]["p50"], result["p50"]
+        if after > before * (1 + tolerance):
+            regressions.append(
+                f"{'/'.join(map(str, key))}: p50 {before * 1e3:.1f}ms -> "
+                f"{after * 1e3:.1f}ms ({after / before - 1:+.0%})"
+            )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sentence segmentation on synthetic documents. "
+        "Run it with model/ and model/training/ on the PYTHONPATH and the "
+        "model artifacts in /opt/ml/model, as in the serving image."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="Sizes of the documents in bytes.",
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=DEFAULT_BACKENDS,
+        help="Backends benchmarked in-process.",
+    )
+    parser.add_argument(
+        "--url",
+        help="Also benchmark the server running at this URL over HTTP.",
+    )
+    parser.add_argument(
+        "--pysbd-max-size",
+        type=int,
+        default=1_000_000,
+        help="Largest document segmented with pySBD, 0 to skip pySBD.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", default="benchmark.json", help="Path of the results."
+    )
+    parser.add_argument(
+        "--baseline", help="Results of a previous run to compare against."
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cases = [
+        (run_in_process, backend, size, args.seed)
+        for backend in args.backends
+        for size in args.sizes
+    ]
+    if args.url:
+        cases += [(run_http, args.url, size, args.seed) for size in args.sizes]
+    cases += [
+        (run_pysbd, size, args.seed)
+        for size in args.sizes
+        if size <= args.pysbd_max_size
+    ]
+
+    results = []
+    for function, *case_args in cases:
+        result = _run_isolated(function, *case_args)
+        if result is None:
+            continue
+        results.append(result)
+        print(
+            f"{result['target']:>10} {result['backend']:>11} "
+            f"{result['size']:>10}B  p50 {result['p50'] * 1e3:9.1f}ms  "
+            f"p99 {result['p99'] * 1e3:9.1f}ms  "
+            f"{result['mb_per_s']:7.2f}MB/s  "
+            f"{result['windows_per_s']:10.0f} windows/s  "
+            f"{result['peak_rss_mb']:7.0f}MB RSS"
+        )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "python": sys.version,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(
+                results, json.load(f)["results"], args.tolerance
+            )
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,712 @@
+import codecs
+import contextlib
 import json
+import os
+import uuid
 
 import numpy as np
 import torch
-from flask import Flask, jsonify, request
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    has_request_context,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from tokenizers import Tokenizer
 
+import backends
+import cascade
+import instrumentation
 import text_dataset
-from cnn import CNNModel
+import thresholds
+from batching import MicroBatcher
 
 app = Flask(__name__)
 
-model = CNNModel()
-model.load_state_dict(torch.load("/opt/ml/model/model.pt"))
-tokenizer = Tokenizer.from_file("/opt/ml/model/tokenizer.json")
+MODEL_DIR = "/opt/ml/model"
 
+tokenizer = Tokenizer.from_file(f"{MODEL_DIR}/tokenizer.json")
 
-def _extract_contexts(
-    encoded_text,
-    target_tokens=None,
-    context_size=6,
-):
+# "document" convolves the whole padded document once and gathers the conv
+# features at the candidates, "window" runs the model on one context window
+# per candidate
+FORWARD_MODE = os.environ.get("MODEL_FORWARD_MODE", "document")
+if FORWARD_MODE not in ("document", "window"):
+    raise ValueError(f"Unknown MODEL_FORWARD_MODE: {FORWARD_MODE}")
+
+# Model artifact used in "document" mode: "eager", or one of the
+# "torchscript", "onnx" and "int8" artifacts exported by train.py --export
+BACKEND = os.environ.get("MODEL_BACKEND", "eager")
+if FORWARD_MODE == "window" and BACKEND != "eager":
+    raise ValueError("MODEL_FORWARD_MODE window requires the eager backend")
+# Only the eager backend runs the eager model, the others would otherwise
+# keep a second copy of the weights in every worker
+model = backends.load_model(MODEL_DIR) if BACKEND == "eager" else None
+scorer = backends.load_scorer(BACKEND, MODEL_DIR, model)
+
+# Probability above which a candidate is a sentence end, tuned on the
+# validation set by train.py unless overridden with MODEL_THRESHOLD
+THRESHOLD = float(
+    os.environ.get("MODEL_THRESHOLD", thresholds.load_threshold(MODEL_DIR))
+)
+
+# Number of characters tokenized and scored at a time, this bounds the memory
+# used per request regardless of the size of the document
+CHUNK_SIZE = int(os.environ.get("MODEL_CHUNK_SIZE", 1_000_000))
+READ_SIZE = 1 << 16
+CONTEXT_SIZE = 6
+# Candidates from concurrent requests are scored together in batches of up to
+# MODEL_MAX_BATCH_SIZE windows, waiting at most MODEL_MAX_BATCH_WAIT_MS for
+# other requests to fill a batch
+MAX_BATCH_SIZE = int(os.environ.get("MODEL_MAX_BATCH_SIZE", 4096))
+MAX_BATCH_WAIT_MS = float(os.environ.get("MODEL_MAX_BATCH_WAIT_MS", 0))
+# Decide unambiguous candidates with the rules learned by cascade.py instead
+# of the model, when MODEL_CASCADE is true
+CASCADE = os.environ.get("MODEL_CASCADE", "false").lower() == "true"
+rules = (
+    cascade.Cascade.load(f"{MODEL_DIR}/{cascade.CASCADE_FILE}")
+    if CASCADE
+    else None
+)
+if rules is not None:
+    rules.check_context(CONTEXT_SIZE)
+# Requests slower than MODEL_PROFILE_SLOW_MS are profiled, and their stack
+# samples written to MODEL_PROFILE_DIR in the collapsed stack format of flame
+# graphs. Profiling is off unless MODEL_PROFILE_SLOW_MS is set.
+PROFILE_SLOW_MS = os.environ.get("MODEL_PROFILE_SLOW_MS")
+PROFILE_DIR = os.environ.get("MODEL_PROFILE_DIR", "/tmp/profiles")
+PROFILE_INTERVAL_MS = float(os.environ.get("MODEL_PROFILE_INTERVAL_MS", 5))
+profiler = None
+if PROFILE_SLOW_MS is not None:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler = instrumentation.SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+NDJSON = "application/x-ndjson"
+# Accept types answered with the (start, end) character offsets of each
+# sentence instead of its text, as JSON, as NDJSON lines of [start, end], or
+# as little-endian int64 start and end pairs
+SPANS_JSON = "application/x-spans+json"
+SPANS_NDJSON = "application/x-spans+ndjson"
+SPANS = "application/x-spans"
+# Number of spans per block of the binary encoding
+SPANS_BLOCK_SIZE = 4096
+JSON = "application/json"
+JSON_LINES = "application/jsonlines"
+
+target_ids = text_dataset.target_token_ids(tokenizer)
+newline_id = tokenizer.token_to_id("\n")
+pad_id = tokenizer.token_to_id("[PAD]")
+
+stage_seconds = instrumentation.Histogram(
+    "model_stage_seconds", instrumentation.LATENCY_BUCKETS, label="stage"
+)
+request_seconds = instrumentation.Histogram(
+    "model_request_seconds", instrumentation.LATENCY_BUCKETS
+)
+document_chars = instrumentation.Histogram(
+    "model_document_chars", (1000, 10_000, 100_000, 1_000_000, 10_000_000)
+)
+request_candidates = instrumentation.Histogram(
+    "model_request_candidates", (10, 100, 1000, 10_000, 100_000, 1_000_000)
+)
+batch_windows = instrumentation.Histogram(
+    "model_batch_windows", (1, 16, 64, 256, 1024, 4096, 16_384, 65_536)
+)
+
+
+def _stage(name):
+    """
+    Time a block of code as a stage of the current request.
+
+    Args:
+        name (str): Name of the stage.
+
+    Returns:
+        object: A context manager timing the block, which does nothing
+        outside of an /invocations request.
+    """
+    if has_request_context() and "timer" in g:
+        return g.timer.stage(name)
+    return contextlib.nullcontext()
+
+
+def _count(name, value):
+    if has_request_context() and "counts" in g:
+        g.counts[name] = g.counts.get(name, 0) + value
+
+
+def _find_candidates(ids, context_size=CONTEXT_SIZE):
+    """
+    Find the candidate sentence ends of a sequence of token ids.
+
+    The first and last context_size tokens are never candidates, they only
+    provide context for the tokens in between.
+
+    Args:
+        ids (np.ndarray): Token IDs.
+        context_size (int): Size of the context window.
+
+    Returns:
+        np.ndarray: The token indexes of the candidates.
+    """
+    return np.flatnonzero(
+        text_dataset.candidate_mask(ids, target_ids, newline_id, context_size)
+    )
+
+
+def _score(ids, token_idxes):
+    """
+    Run the model on the candidates of a sequence of token ids.
+
+    Args:
+        ids (np.ndarray): Token IDs.
+        token_idxes (np.ndarray): Token indexes of the candidates.
+
+    Returns:
+        np.ndarray: The predicted probability of each candidate.
+    """
+    batch_windows.observe(len(token_idxes))
+    if FORWARD_MODE == "document":
+        return scorer(ids, token_idxes)
+
+    contexts = text_dataset.extract_windows(ids, token_idxes, CONTEXT_SIZE)
+    with torch.no_grad():
+        probs = model(torch.from_numpy(contexts))
+    return probs.flatten().numpy()
+
+
+batcher = MicroBatcher(
+    _score,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait=MAX_BATCH_WAIT_MS / 1000,
+    context_size=CONTEXT_SIZE,
+)
+
+
+def _predict_candidates(ids, in_document=None):
+    """
+    Predict the probability of each candidate being a sentence end.
+
+    Args:
+        ids (np.ndarray): Token IDs.
+        in_document (np.ndarray): Boolean mask over the tokens, False for
+            the padding between documents, which is never a candidate.
+
+    Returns:
+        tuple: A tuple containing the token indexes of the candidates and
+        their predicted probabilities.
+    """
+    with _stage("candidates"):
+        token_idxes = _find_candidates(ids)
+        if in_document is not None:
+            token_idxes = token_idxes[in_document[token_idxes]]
+    _count("candidates", len(token_idxes))
+    if rules is None:
+        with _stage("forward"):
+            return token_idxes, batcher.score(ids, token_idxes)
+
+    with _stage("cascade"):
+        decisions = rules.decide(ids, token_idxes)
+        undecided = decisions == cascade.UNDECIDED
+        probs = decisions.astype(np.float32)
+    with _stage("forward"):
+        probs[undecided] = batcher.score(ids, token_idxes[undecided])
+    return token_idxes, probs
+
+
+def _iter_text_chunks(stream, chunk_size=CHUNK_SIZE):
+    """
+    Read and decode a UTF-8 byte stream in chunks of text.
+
+    Chunks are cut at a space, tab or newline where possible. These always
+    separate tokens, so tokenizing the chunks one by one gives the same
+    tokens as tokenizing the whole text.
+
+    Args:
+        stream (object): Binary file-like object.
+        chunk_size (int): Maximum number of characters per chunk.
+
+    Yields:
+        str: The chunks of text.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    while True:
+        with _stage("decode"):
+            block = stream.read(READ_SIZE)
+            text = decoder.decode(block, final=not block)
+        _count("chars", len(text))
+        buffer += text
+        while len(buffer) >= chunk_size:
+            cut = max(
+                buffer.rfind(" ", 1, chunk_size),
+                buffer.rfind("\t", 1, chunk_size),
+                buffer.rfind("\n", 1, chunk_size),
+            )
+            if cut == -1:
+                cut = chunk_size
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+        if not block:
+            break
+    if buffer:
+        yield buffer
+
+
+def _iter_sentence_ends(text_chunks, context_size=CONTEXT_SIZE):
+    """
+    Predict the sentence ends of a text given in chunks.
+
+    The last 2 * context_size tokens of each chunk are carried over to the
+    next one: the first half as left context, the second half because their
+    right context is only known once the next chunk is tokenized.
+
+    Args:
+        text_chunks (iterable): Chunks of text.
+        context_size (int): Size of the context window.
+
+    Yields:
+        int: Character offsets of the sentence ends, in order.
+    """
+    padding = np.full(context_size, pad_id, dtype=np.int32)
+    carry_ids = padding
+    carry_ends = np.zeros(context_size, dtype=np.int64)
+    offset = 0
+
+    for chunk in text_chunks:
+        with _stage("tokenize"):
+            encoded = tokenizer.encode(chunk)
+        with _stage("pad"):
+            offsets = np.array(encoded.offsets, np.int64).reshape(-1, 2)
+            ids = np.concatenate([carry_ids, np.array(encoded.ids, np.int32)])
+            ends = np.concatenate([carry_ends, offsets[:, 1] + offset])
+        offset += len(chunk)
+
+        token_idxes, probs = _predict_candidates(ids)
+        yield from ends[token_idxes[probs > THRESHOLD]].tolist()
+
+        carry_start = max(0, len(ids) - 2 * context_size)
+        carry_ids, carry_ends = ids[carry_start:], ends[carry_start:]
+
+    with _stage("pad"):
+        ids = np.concatenate([carry_ids, padding])
+        ends = np.concatenate([carry_ends, np.zeros(context_size, np.int64)])
+    token_idxes, probs = _predict_candidates(ids)
+    yield from ends[token_idxes[probs > THRESHOLD]].tolist()
+
+
+def _trim(text, start, end):
+    """
+    Trim the whitespace of text[start:end] without copying it.
+
+    Args:
+        text (str): The text.
+        start (int): Start offset.
+        end (int): End offset.
+
+    Returns:
+        tuple: The offsets of text[start:end].strip().
+    """
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _iter_sentences(text_chunks):
+    """
+    Find the sentences of a text given in chunks.
+
+    Only the text since the last sentence end is kept in memory.
+
+    Args:
+        text_chunks (iterable): Chunks of text.
+
+    Yields:
+        tuple: The text kept in memory and its offset in the document, the
+        start and end offsets of the sentence, whitespace trimmed except for
+        the first sentence, and the offset of the sentence end.
     """
-    Extract context windows and labels.
+    text = ""
+    text_start = 0
+    new_chunks = []
+    prev_end = None
+
+    def read_chunks():
+        for chunk in text_chunks:
+            new_chunks.append(chunk)
+            yield chunk
+
+    for end in _iter_sentence_ends(read_chunks()):
+        with _stage("segments"):
+            if new_chunks:
+                keep_from = 0 if prev_end is None else prev_end - text_start
+                text = text[keep_from:] + "".join(new_chunks)
+                text_start += keep_from
+                new_chunks.clear()
+
+            if prev_end is None:
+                start, stop = 0, end
+            else:
+                start, stop = _trim(
+                    text, prev_end - text_start, end - text_start
+                )
+                start, stop = start + text_start, stop + text_start
+            prev_end = end
+        yield text, text_start, start, stop, end
+
+
+def _iter_segments(text_chunks):
+    """
+    Segment a text given in chunks into sentences.
 
     Args:
-        encoded_texts (list): List of encoded texts.
-        labels (list): List of labels.
-        target_tokens (list): List of target tokens to consider for
-            context extraction.
+        text_chunks (iterable): Chunks of text.
+
+    Yields:
+        tuple: A tuple containing the sentence and its end offset.
+    """
+    for text, text_start, start, stop, end in _iter_sentences(text_chunks):
+        yield text[start - text_start : stop - text_start], end
+
+
+def _iter_spans(text_chunks):
+    """
+    Find the character offsets of the sentences of a text given in chunks.
+
+    Args:
+        text_chunks (iterable): Chunks of text.
+
+    Yields:
+        tuple: The start and end offsets of each sentence, such that
+        text[start:end] is the sentence returned by _iter_segments.
+    """
+    for _, _, start, stop, _ in _iter_sentences(text_chunks):
+        yield start, stop
+
+
+def _predict_batch(texts, context_size=CONTEXT_SIZE):
+    """
+    Predict the sentence ends of several documents in one forward pass.
+
+    The documents are encoded with encode_batch and concatenated, separated
+    by context_size padding tokens, so that no context window spans two
+    documents. The padding is never a candidate, even when the next
+    document starts with a newline.
+
+    Args:
+        texts (list): List of documents.
         context_size (int): Size of the context window.
 
     Returns:
-        tuple: A tuple containing window IDs and window labels.
+        list: The list of character offsets of the sentence ends of each
+        document.
+    """
+    padding = np.full(context_size, pad_id, dtype=np.int32)
+    no_ends = np.zeros(context_size, dtype=np.int64)
+    not_in_document = np.zeros(context_size, dtype=bool)
+    all_ids = [padding]
+    all_ends = [no_ends]
+    all_in_document = [not_in_document]
+    doc_starts = []
+    num_tokens = context_size
+
+    with _stage("tokenize"):
+        encodings = tokenizer.encode_batch(texts)
+
+    with _stage("pad"):
+        for encoded in encodings:
+            offsets = np.array(encoded.offsets, np.int64).reshape(-1, 2)
+            all_ids += [np.array(encoded.ids, np.int32), padding]
+            all_ends += [offsets[:, 1], no_ends]
+            all_in_document += [np.ones(len(encoded), bool), not_in_document]
+            doc_starts.append(num_tokens)
+            num_tokens += len(encoded) + context_size
+
+        ids = np.concatenate(all_ids)
+        ends = np.concatenate(all_ends)
+        in_document = np.concatenate(all_in_document)
+    token_idxes, probs = _predict_candidates(ids, in_document)
+
+    with _stage("segments"):
+        end_token_idxes = token_idxes[probs > THRESHOLD]
+        doc_idxes = (
+            np.searchsorted(doc_starts, end_token_idxes, side="right") - 1
+        )
+        splits = np.searchsorted(doc_idxes, np.arange(1, len(texts)))
+        return [
+            doc_ends.tolist()
+            for doc_ends in np.split(ends[end_token_idxes], splits)
+        ][: len(texts)]
+
+
+def _build_spans(text, ends):
+    """
+    Find the character offsets of the sentences of a document.
+
+    Args:
+        text (str): The document.
+        ends (list): Character offsets of the sentence ends.
+
+    Returns:
+        list: The [start, end] offsets of each sentence, such that
+        text[start:end] is the sentence returned by _build_segments.
     """
-    if target_tokens is None:
-        target_tokens = [".", '"', "]", ")", ":", '"', "'", "*", ">", ";"]
+    if not ends:
+        return []
+    return [[0, ends[0]]] + [
+        list(_trim(text, ends[i], ends[i + 1])) for i in range(len(ends) - 1)
+    ]
+
 
-    window_ids = []
-    token_idxes = []
+def _build_segments(text, ends):
+    """
+    Split a document into sentences at the given sentence ends.
 
-    tokens = encoded_text.tokens
-    num_tokens = len(tokens)
-    for i in range(num_tokens):
-        token = tokens[i]
-        if (token in target_tokens) or text_dataset._is_end_of_line(tokens, i):
-            start = max(0, i - context_size)
-            end = min(len(encoded_text), i + context_size + 1)
-            window_ids.append(encoded_text.ids[start:end])
-            token_idxes.append(i)
+    Args:
+        text (str): The document.
+        ends (list): Character offsets of the sentence ends.
 
-    return window_ids, token_idxes
+    Returns:
+        list: The sentences.
+    """
+    return [text[start:end] for start, end in _build_spans(text, ends)]
+
+
+def _read_batch():
+    """
+    Read a batch of documents from a JSON or JSON Lines request.
+
+    Returns:
+        list: The documents.
+    """
+    with _stage("decode"):
+        if request.mimetype == JSON:
+            texts = request.get_json()
+        else:
+            lines = request.get_data(as_text=True).splitlines()
+            try:
+                texts = [json.loads(line) for line in lines if line.strip()]
+            except json.JSONDecodeError as e:
+                abort(400, f"Malformed JSON Lines: {e}")
+
+    if not isinstance(texts, list) or not all(
+        isinstance(text, str) for text in texts
+    ):
+        abort(400, "Expected a list of documents as strings")
+    _count("chars", sum(len(text) for text in texts))
+    return texts
+
+
+def _predict_documents():
+    """
+    Segment a batch of documents given as JSON or JSON Lines.
+
+    Returns:
+        Response: A JSON list, or JSON Lines for a JSON Lines request, with
+        the segments and ends of each document.
+    """
+    texts = _read_batch()
+    all_ends = _predict_batch(texts)
+    with _stage("segments"):
+        if request.accept_mimetypes.best == SPANS_JSON:
+            results = [
+                {"spans": _build_spans(text, ends)}
+                for text, ends in zip(texts, all_ends)
+            ]
+        else:
+            results = [
+                {"segments": _build_segments(text, ends), "ends": ends}
+                for text, ends in zip(texts, all_ends)
+            ]
+
+    with _stage("serialize"):
+        if request.mimetype == JSON:
+            return jsonify(results)
+        return Response(
+            "".join(json.dumps(result) + "\n" for result in results),
+            mimetype=JSON_LINES,
+        )
+
+
+def _iter_ndjson(segments):
+    """Encode segments as newline-delimited JSON, one object per line."""
+    for segment, end in segments:
+        with _stage("serialize"):
+            line = json.dumps({"segment": segment, "end": end}) + "\n"
+        yield line
+
+
+def _iter_spans_ndjson(spans):
+    """Encode spans as newline-delimited JSON, one [start, end] per line."""
+    for start, end in spans:
+        yield f"[{start},{end}]\n"
+
+
+def _iter_spans_binary(spans):
+    """Encode spans as blocks of little-endian int64 start and end pairs."""
+    block = []
+    for span in spans:
+        block.append(span)
+        if len(block) == SPANS_BLOCK_SIZE:
+            yield np.array(block, dtype="<i8").tobytes()
+            block.clear()
+    if block:
+        yield np.array(block, dtype="<i8").tobytes()
+
+
+def warm_up():
+    """Run a small document through the model so the first request is fast."""
+    text = "This is a warm up.\nIt has (1) two lines; and three sentences."
+    list(_iter_segments([text]))
+    _predict_batch([text, text])
+
+
+def _record_request(timer, counts):
+    """
+    Record the metrics of a finished request, and its profile if slow.
+
+    Args:
+        timer (instrumentation.StageTimer): Stage durations of the request.
+        counts (dict): Number of characters and candidates of the request.
+    """
+    elapsed = timer.elapsed()
+    for name, duration in timer.durations.items():
+        stage_seconds.observe(duration, name)
+    request_seconds.observe(elapsed)
+    document_chars.observe(counts.get("chars", 0))
+    request_candidates.observe(counts.get("candidates", 0))
+
+    if profiler is None:
+        return
+    samples = profiler.stop()
+    if samples and elapsed * 1e3 >= float(PROFILE_SLOW_MS):
+        path = os.path.join(
+            PROFILE_DIR, f"{elapsed * 1e3:.0f}ms-{uuid.uuid4().hex}.txt"
+        )
+        instrumentation.write_collapsed(samples, path)
+
+
+@app.before_request
+def _start_request():
+    if request.endpoint != "predict":
+        return
+    g.timer = instrumentation.StageTimer()
+    g.counts = {}
+    if profiler is not None:
+        profiler.start()
+
+
+@app.after_request
+def _finish_request(response):
+    if "timer" not in g:
+        return response
+    # A streamed body is produced after the headers are sent, so its stages
+    # are only recorded in the histograms
+    if response.mimetype not in (NDJSON, SPANS_NDJSON, SPANS):
+        response.headers["Server-Timing"] = g.timer.server_timing()
+    timer, counts = g.timer, g.counts
+    response.call_on_close(lambda: _record_request(timer, counts))
+    g.recorded_on_close = True
+    return response
+
+
+@app.teardown_request
+def _teardown_request(exc):
+    # Without a response to record it on close, e.g. when a request raised
+    # before _finish_request, the profile of the request is dropped here
+    if profiler is not None and "timer" in g and "recorded_on_close" not in g:
+        profiler.stop()
 
 
 @app.route("/ping", methods=["GET"])
 def ping():
-    health = isinstance(model, CNNModel) & isinstance(tokenizer, Tokenizer)
+    health = callable(scorer) & isinstance(tokenizer, Tokenizer)
     status = 200 if health else 404
     return "", status
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    lines = [
+        "# TYPE model_batches_total counter",
+        f"model_batches_total {batcher.batches}",
+        "# TYPE model_batch_requests_total counter",
+        f"model_batch_requests_total {batcher.requests}",
+        "# TYPE model_batch_windows_total counter",
+        f"model_batch_windows_total {batcher.windows}",
+        "# TYPE model_batch_wait_seconds_total counter",
+        f"model_batch_wait_seconds_total {batcher.wait_seconds}",
+        "# TYPE model_max_batch_size gauge",
+        f"model_max_batch_size {batcher.max_batch_size}",
+        "# TYPE model_max_batch_wait_seconds gauge",
+        f"model_max_batch_wait_seconds {batcher.max_wait}",
+    ]
+    if rules is not None:
+        lines += [
+            "# TYPE model_cascade_candidates_total counter",
+            f"model_cascade_candidates_total {rules.candidates}",
+            "# TYPE model_cascade_skipped_total counter",
+            f"model_cascade_skipped_total {rules.skipped}",
+        ]
+    for histogram in (
+        request_seconds,
+        stage_seconds,
+        document_chars,
+        request_candidates,
+        batch_windows,
+    ):
+        lines += histogram.render()
+    return Response("\n".join(lines) + "\n", mimetype="text/plain")
+
+
 @app.route("/invocations", methods=["POST"])
 def predict():
-    text_data = request.get_data()
-    if type(text_data) is bytes:
-        text_data = text_data.decode("utf-8")
+    if request.mimetype in (JSON, JSON_LINES):
+        return _predict_documents()
 
-    pad_id = tokenizer.token_to_id("[PAD]")
-    encoded = tokenizer.encode(text_data)
-    encoded.pad(len(encoded) + 6, direction="left", pad_id=pad_id)
-    encoded.pad(len(encoded) + 6, direction="right", pad_id=pad_id)
+    text_chunks = _iter_text_chunks(request.stream)
+    accept = request.accept_mimetypes.best
 
-    contexts, token_idxes = _extract_contexts(encoded)
-    contexts = torch.tensor(contexts, dtype=torch.int32, device="cpu")
+    if accept == SPANS_NDJSON:
+        spans = _iter_spans(text_chunks)
+        return Response(
+            stream_with_context(_iter_spans_ndjson(spans)),
+            mimetype=SPANS_NDJSON,
+        )
 
-    with torch.no_grad():
-        prediction = (model(contexts) > 0.5).flatten()
+    if accept == SPANS:
+        spans = _iter_spans(text_chunks)
+        return Response(
+            stream_with_context(_iter_spans_binary(spans)), mimetype=SPANS
+        )
 
-    end_token_idxes = np.array(token_idxes)[prediction]
+    if accept == SPANS_JSON:
+        spans = list(_iter_spans(text_chunks))
+        with _stage("serialize"):
+            return Response(
+                json.dumps({"spans": spans}, separators=(",", ":")),
+                mimetype=SPANS_JSON,
+            )
 
-    ends = np.array(encoded.offsets)[:, 1][end_token_idxes].tolist()
-
-    segments = [text_data[:ends[0]]] + [
-        text_data[ends[i] : ends[i + 1]].strip() for i in range(len(ends) - 1)
-    ]
+    segments = _iter_segments(text_chunks)
+    if accept == NDJSON:
+        return Response(
+            stream_with_context(_iter_ndjson(segments)), mimetype=NDJSON
+        )
 
-    return jsonify({"segments": segments, "ends": ends})
+    segments = list(segments)
+    with _stage("serialize"):
+        return jsonify(
+            {
+                "segments": [segment for segment, _ in segments],
+                "ends": [end for _, end in segments],
+            }
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# Bucket upper bounds in seconds of the latency histograms
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    def __init__(self, name, buckets, label=None):
+        """
+        Prometheus histogram, optionally split by the values of one label.
+
+        Args:
+            name (str): Metric name.
+            buckets (tuple): Increasing upper bounds of the buckets.
+            label (str): Name of the label, or None for an unlabelled
+                histogram.
+        """
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {
+                    "counts": [0] * len(self.buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def sum(self, label_value=None):
+        """
+        Sum of the observed values.
+
+        Args:
+            label_value (str): Value of the label of the series.
+
+        Returns:
+            float: The sum, 0 if nothing was observed.
+        """
+        with self._lock:
+            series = self._series.get(label_value)
+            return series["sum"] if series is not None else 0.0
+
+    def render(self):
+        """
+        Render the histogram in the Prometheus text format.
+
+        Returns:
+            list: The lines of the histogram.
+        """
+        lines = [f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(
+                self._series.items(), key=lambda item: str(item[0])
+            ):
+                labels = (
+                    ""
+                    if self.label is None
+                    else f'{self.label}="{label_value}",'
+                )
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(
+                        f'{self.name}_bucket{{{labels}le="{bound}"}} '
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f'{self.name}_bucket{{{labels}le="+Inf"}} '
+                    f"{series['count']}"
+                )
+                labels = labels.rstrip(",")
+                labels = f"{{{labels}}}" if labels else ""
+                lines.append(f"{self.name}_sum{labels} {series['sum']}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        durations = self.timer.durations
+        elapsed = time.perf_counter() - self.start
+        durations[self.name] = durations.get(self.name, 0.0) + elapsed
+
+
+class StageTimer:
+    def __init__(self):
+        """
+        Accumulate the time a request spends in each stage.
+
+        A stage can be entered several times, for example once per chunk of
+        a streamed document, and its durations are summed.
+        """
+        self.start = time.perf_counter()
+        self.durations = {}
+
+    def stage(self, name):
+        """
+        Time a block of code as part of a stage.
+
+        Args:
+            name (str): Name of the stage.
+
+        Returns:
+            object: A context manager timing the block.
+        """
+        return _Stage(self, name)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """
+        Format the stage durations as a Server-Timing header.
+
+        Returns:
+            str: One metric per stage with its duration in milliseconds,
+            followed by the total time of the request so far.
+        """
+        metrics = [
+            f"{name};dur={duration * 1e3:.3f}"
+            for name, duration in self.durations.items()
+        ]
+        metrics.append(f"total;dur={self.elapsed() * 1e3:.3f}")
+        return ", ".join(metrics)
+
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+            f"{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        """
+        Sample the Python stacks of the threads handling requests.
+
+        A background thread samples every started thread each interval, and
+        the samples are returned in the collapsed stack format read by
+        flamegraph.pl and speedscope.
+
+        Args:
+            interval (float): Time in seconds between samples.
+        """
+        self.interval = interval
+        self._samples = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start sampling the current thread."""
+        with self._lock:
+            self._samples[threading.get_ident()] = collections.Counter()
+            # Started lazily so that it is created in each worker process
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling the current thread.
+
+        Returns:
+            collections.Counter: Number of samples of each collapsed stack.
+        """
+        with self._lock:
+            return self._samples.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._samples.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+
+
+def write_collapsed(samples, path):
+    """
+    Write stack samples in the collapsed stack format.
+
+    Args:
+        samples (collections.Counter): Number of samples of each stack.
+        path (str): Path of the file to write.
+    """
+    with open(path, "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
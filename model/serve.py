@@ -0,0 +1,75 @@
+import gc
+import os
+
+import torch
+from gunicorn.app.base import BaseApplication
+
+# Each worker runs its own copy of the request handlers, and torch uses
+# MODEL_TORCH_THREADS threads per worker, so that workers do not compete for
+# the same cores
+WORKERS = int(os.environ.get("MODEL_WORKERS", os.cpu_count()))
+TORCH_THREADS = int(
+    os.environ.get("MODEL_TORCH_THREADS", max(1, os.cpu_count() // WORKERS))
+)
+WORKER_THREADS = int(os.environ.get("MODEL_WORKER_THREADS", 4))
+# The threads of a worker can have their candidates scored together by the
+# MicroBatcher of inference.py, waiting up to MODEL_MAX_BATCH_WAIT_MS for
+# each other. It defaults to 0, which scores each request in its own thread:
+# with 4 threads, 1 torch thread and 10 KB documents, waiting 1 to 5 ms
+# coalesced fewer than 2 requests per batch and lowered throughput, while
+# skipping the batcher thread raised it from about 50 to 65 requests/s.
+TIMEOUT = int(os.environ.get("MODEL_SERVER_TIMEOUT", 120))
+
+
+def post_fork(server, worker):
+    torch.set_num_threads(TORCH_THREADS)
+
+
+def post_worker_init(worker):
+    import inference
+
+    inference.warm_up()
+    worker.log.info(
+        f"Worker {worker.pid} warmed up with {TORCH_THREADS} torch threads"
+    )
+
+
+class ModelServer(BaseApplication):
+    def __init__(self, options):
+        """
+        Gunicorn application serving the inference app.
+
+        The app is loaded in the master process before the workers are
+        forked, so the model weights are shared copy-on-write between them.
+
+        Args:
+            options (dict): Gunicorn settings.
+        """
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import inference
+
+        # Keep the garbage collector from touching the objects loaded before
+        # the fork, which would copy their memory pages into every worker
+        gc.freeze()
+        return inference.app
+
+
+if __name__ == "__main__":
+    options = {
+        "bind": "0.0.0.0:8080",
+        "workers": WORKERS,
+        "worker_class": "gthread",
+        "threads": WORKER_THREADS,
+        "timeout": TIMEOUT,
+        "preload_app": True,
+        "post_fork": post_fork,
+        "post_worker_init": post_worker_init,
+    }
+    ModelServer(options).run()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# The server imports the training modules as top-level modules, as in the
+# Docker image
+MODEL_DIR = Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(MODEL_DIR), str(MODEL_DIR / "training")]
@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import pytest
+
+if not Path("/opt/ml/model/tokenizer.json").exists():
+    pytest.skip("No model artifacts in /opt/ml/model", allow_module_level=True)
+
+import inference  # noqa: E402
+
+
+@pytest.fixture
+def every_candidate(monkeypatch):
+    # Every candidate is a sentence end, whatever the model predicts
+    monkeypatch.setattr(inference, "THRESHOLD", -1.0)
+
+
+def test_predict_batch_ignores_padding_before_newline(every_candidate):
+    texts = [
+        "The parties agree. This contract is binding.",
+        "\nSection 2. Payment is due in 30 days.\nSection 3",
+    ]
+    batch_ends = inference._predict_batch(texts)
+    assert batch_ends == [
+        inference._predict_batch([text])[0] for text in texts
+    ]
+    for text, ends in zip(texts, batch_ends):
+        assert ends == sorted(ends)
+        assert all(0 < end <= len(text) for end in ends)
+
+
+def test_malformed_json_lines_is_a_bad_request():
+    client = inference.app.test_client()
+    response = client.post(
+        "/invocations",
+        data='"The parties agree."\n{"text": \n',
+        content_type=inference.JSON_LINES,
+    )
+    assert response.status_code == 400
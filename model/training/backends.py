@@ -0,0 +1,257 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+import thresholds
+from cnn import CNNModel
+
+ARTIFACTS = {
+    "eager": "model.pt",
+    "torchscript": "model.torchscript.pt",
+    "onnx": "model.onnx",
+    "int8": "model.int8.pt",
+}
+# CNNModel arguments of models trained with other than the default ones
+CONFIG_FILE = "config.json"
+
+# Maximum fraction of held-out candidates on which the sentence end decision
+# of a backend may differ from the eager model
+PARITY_TOLERANCE = {
+    "eager": 0.0,
+    "torchscript": 1e-4,
+    "onnx": 1e-4,
+    "int8": 1e-3,
+}
+
+
+class DocumentScorer(nn.Module):
+    def __init__(self, model):
+        """
+        Expose CNNModel.forward_document as forward, for export.
+
+        Args:
+            model (CNNModel): The model to wrap.
+        """
+        super(DocumentScorer, self).__init__()
+        self.model = model
+
+    def forward(self, ids, token_idxes):
+        return self.model.forward_document(ids, token_idxes)
+
+
+def save_config(artifacts_dir, config):
+    """
+    Write the CNNModel arguments of a model next to its other artifacts.
+
+    Args:
+        artifacts_dir (str): Directory containing the model artifacts.
+        config (dict): CNNModel arguments.
+    """
+    with open(Path(artifacts_dir) / CONFIG_FILE, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def load_config(artifacts_dir):
+    """
+    Load the CNNModel arguments of a model.
+
+    Args:
+        artifacts_dir (str): Directory containing the model artifacts.
+
+    Returns:
+        dict: The arguments written by save_config, empty for artifacts
+        without them.
+    """
+    path = Path(artifacts_dir) / CONFIG_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_model(artifacts_dir):
+    """
+    Load the eager model of a set of artifacts.
+
+    Args:
+        artifacts_dir (str): Directory containing the model artifacts.
+
+    Returns:
+        CNNModel: The model, in eval mode.
+    """
+    model = CNNModel(**load_config(artifacts_dir))
+    model.load_state_dict(torch.load(Path(artifacts_dir) / ARTIFACTS["eager"]))
+    return model.eval()
+
+
+def quantize(model):
+    """
+    Dynamically quantize the linear layers of a model to int8.
+
+    Args:
+        model (CNNModel): The model to quantize.
+
+    Returns:
+        nn.Module: The quantized model.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, {nn.Linear}, dtype=torch.qint8
+    )
+
+
+def export(model, artifacts_dir):
+    """
+    Export TorchScript, ONNX and int8 TorchScript versions of a model.
+
+    The exported artifacts score whole documents, taking the token IDs and
+    the candidate token indexes as inputs like CNNModel.forward_document.
+
+    Args:
+        model (CNNModel): The trained model.
+        artifacts_dir (str): Directory to write the artifacts to.
+    """
+    artifacts_dir = Path(artifacts_dir)
+    model.eval()
+
+    scorer = DocumentScorer(model)
+    torch.jit.script(scorer).save(artifacts_dir / ARTIFACTS["torchscript"])
+    torch.jit.script(DocumentScorer(quantize(model))).save(
+        artifacts_dir / ARTIFACTS["int8"]
+    )
+
+    num_tokens = 4 * model.context_window
+    ids = torch.zeros(num_tokens, dtype=torch.int32)
+    token_idxes = torch.arange(
+        model.context_window, num_tokens - model.context_window
+    )
+    torch.onnx.export(
+        scorer,
+        (ids, token_idxes),
+        artifacts_dir / ARTIFACTS["onnx"],
+        input_names=["ids", "token_idxes"],
+        output_names=["probs"],
+        dynamic_axes={
+            "ids": {0: "num_tokens"},
+            "token_idxes": {0: "num_candidates"},
+            "probs": {0: "num_candidates"},
+        },
+    )
+
+
+def load_scorer(backend, artifacts_dir, model=None):
+    """
+    Load a model backend.
+
+    Args:
+        backend (str): One of "eager", "torchscript", "onnx" or "int8".
+        artifacts_dir (str): Directory containing the artifacts.
+        model (CNNModel): Already loaded eager model, used by the eager
+            backend instead of loading the weights again.
+
+    Returns:
+        callable: Function taking the token IDs and candidate token indexes
+        as arrays, returning the probability of each candidate.
+    """
+    if backend not in ARTIFACTS:
+        raise ValueError(f"Unknown model backend: {backend}")
+    path = Path(artifacts_dir) / ARTIFACTS[backend]
+
+    if backend == "onnx":
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(
+            str(path), providers=["CPUExecutionProvider"]
+        )
+
+        def score(ids, token_idxes):
+            if len(token_idxes) == 0:
+                return np.empty(0, dtype=np.float32)
+            inputs = {
+                "ids": ids.astype(np.int32, copy=False),
+                "token_idxes": token_idxes.astype(np.int64, copy=False),
+            }
+            return session.run(None, inputs)[0].flatten()
+
+        return score
+
+    if backend == "eager":
+        forward = (model or load_model(artifacts_dir)).forward_document
+    else:
+        forward = torch.jit.load(path).eval()
+
+    def score(ids, token_idxes):
+        with torch.no_grad():
+            probs = forward(
+                torch.from_numpy(ids), torch.from_numpy(token_idxes)
+            )
+        return probs.flatten().numpy()
+
+    return score
+
+
+def score_windows(score, window_ids, batch_size=65536):
+    """
+    Score context windows with a document scorer.
+
+    The windows are laid end to end, so the candidate of each window is its
+    centre token and its context is the rest of the window.
+
+    Args:
+        score (callable): Scorer returned by load_scorer.
+        window_ids (np.ndarray): Array of shape (n_windows, window_size).
+        batch_size (int): Number of windows scored at a time.
+
+    Returns:
+        np.ndarray: The probability of each window.
+    """
+    window_size = window_ids.shape[1]
+    probs = [np.empty(0, dtype=np.float32)]
+    for start in range(0, len(window_ids), batch_size):
+        batch = window_ids[start : start + batch_size]
+        token_idxes = np.arange(len(batch)) * window_size + window_size // 2
+        probs.append(score(np.ascontiguousarray(batch).ravel(), token_idxes))
+    return np.concatenate(probs)
+
+
+def check_parity(artifacts_dir, window_ids, backends=None):
+    """
+    Check that exported backends agree with the eager model.
+
+    Decisions are compared at the threshold served with the artifacts.
+
+    Args:
+        artifacts_dir (str): Directory containing the artifacts.
+        window_ids (np.ndarray): Held-out context windows.
+        backends (list): Backends to check, defaults to all exported ones.
+
+    Returns:
+        dict: For each backend, the fraction of windows where the sentence
+        end decision differs from the eager model, and the maximum absolute
+        difference in probability.
+
+    Raises:
+        ValueError: If a backend disagrees more than its PARITY_TOLERANCE.
+    """
+    if backends is None:
+        backends = [backend for backend in ARTIFACTS if backend != "eager"]
+
+    threshold = thresholds.load_threshold(artifacts_dir)
+    reference = score_windows(load_scorer("eager", artifacts_dir), window_ids)
+    results = {}
+    for backend in backends:
+        probs = score_windows(load_scorer(backend, artifacts_dir), window_ids)
+        mismatch = float(
+            np.mean((probs > threshold) != (reference > threshold))
+        )
+        max_diff = float(np.max(np.abs(probs - reference), initial=0.0))
+        results[backend] = {"mismatch": mismatch, "max_diff": max_diff}
+        if mismatch > PARITY_TOLERANCE[backend]:
+            raise ValueError(
+                f"{backend} backend disagrees with the eager model on "
+                f"{mismatch:.4%} of windows, above the tolerance of "
+                f"{PARITY_TOLERANCE[backend]:.4%}"
+            )
+    return results
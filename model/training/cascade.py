@@ -0,0 +1,291 @@
+import argparse
+import threading
+from pathlib import Path
+
+import numpy as np
+
+ARTIFACTS_DIR = "./artifacts"
+CASCADE_FILE = "cascade.npz"
+# Token offsets from the candidate that make up the context a rule matches
+DEFAULT_OFFSETS = (-1, 0, 1, 2)
+UNDECIDED = -1
+
+
+class Cascade:
+    def __init__(self, offsets, vocab_size, keys, decisions):
+        """
+        Decide unambiguous candidates from their surrounding tokens.
+
+        A rule maps the tokens at the given offsets from a candidate to a
+        decision. Rules are learned by fit from contexts that are (almost)
+        always or never sentence ends, and candidates that no rule matches
+        are left to the model.
+
+        Args:
+            offsets (tuple): Token offsets from the candidate matched by the
+                rules.
+            vocab_size (int): Size of the tokenizer vocabulary.
+            keys (np.ndarray): Sorted keys of the contexts of the rules.
+            decisions (np.ndarray): Decision of each rule, 1 for a sentence
+                end and 0 otherwise.
+        """
+        self.offsets = tuple(int(offset) for offset in offsets)
+        self.vocab_size = int(vocab_size)
+        # A key holds one base vocab_size digit per offset, and distinct
+        # contexts would collide if the keys overflowed int64
+        if self.vocab_size ** len(self.offsets) > 2**63:
+            raise ValueError(
+                f"{len(self.offsets)} offsets over a vocabulary of "
+                f"{self.vocab_size} tokens do not fit in int64 keys"
+            )
+        self.keys = keys
+        self.decisions = decisions
+        self.candidates = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fit(
+        cls,
+        window_ids,
+        labels,
+        vocab_size,
+        offsets=DEFAULT_OFFSETS,
+        min_support=50,
+        min_precision=0.999,
+    ):
+        """
+        Learn the rules from labelled context windows.
+
+        Args:
+            window_ids (np.ndarray): Training context windows.
+            labels (np.ndarray): Label of each window.
+            vocab_size (int): Size of the tokenizer vocabulary.
+            offsets (tuple): Token offsets from the candidate matched by the
+                rules.
+            min_support (int): Number of windows a context must appear in
+                to become a rule.
+            min_precision (float): Fraction of these windows that must have
+                the same label.
+
+        Returns:
+            Cascade: The learned cascade.
+        """
+        cascade = cls(offsets, vocab_size, np.empty(0, np.int64), None)
+        keys = cascade._window_keys(window_ids)
+        unique_keys, inverse, counts = np.unique(
+            keys, return_inverse=True, return_counts=True
+        )
+        ends = np.bincount(
+            inverse, weights=np.asarray(labels), minlength=len(unique_keys)
+        )
+
+        supported = counts >= min_support
+        always_end = supported & (ends >= min_precision * counts)
+        never_end = supported & (counts - ends >= min_precision * counts)
+        rules = always_end | never_end
+        cascade.keys = unique_keys[rules]
+        cascade.decisions = always_end[rules].astype(np.int8)
+        return cascade
+
+    def check_context(self, context_size):
+        """
+        Check that the offsets fall within the context of the model.
+
+        Args:
+            context_size (int): Number of tokens of context on each side of
+                a candidate.
+        """
+        if max(abs(offset) for offset in self.offsets) > context_size:
+            raise ValueError(
+                f"Cascade offsets {self.offsets} reach beyond the context "
+                f"of {context_size} tokens"
+            )
+
+    def _keys(self, contexts):
+        keys = np.zeros(len(contexts), dtype=np.int64)
+        for column in range(contexts.shape[1]):
+            keys = keys * self.vocab_size + contexts[:, column]
+        return keys
+
+    def _window_keys(self, window_ids):
+        center = window_ids.shape[1] // 2
+        self.check_context(center)
+        columns = [center + offset for offset in self.offsets]
+        return self._keys(np.asarray(window_ids)[:, columns])
+
+    def _lookup(self, keys):
+        decisions = np.full(len(keys), UNDECIDED, dtype=np.int8)
+        if len(self.keys) == 0:
+            return decisions
+        idxes = np.searchsorted(self.keys, keys).clip(max=len(self.keys) - 1)
+        found = self.keys[idxes] == keys
+        decisions[found] = self.decisions[idxes[found]]
+        return decisions
+
+    def decide_windows(self, window_ids):
+        """
+        Decide the candidates of context windows.
+
+        Args:
+            window_ids (np.ndarray): Context windows.
+
+        Returns:
+            np.ndarray: 1 for a sentence end, 0 for no sentence end, and
+            UNDECIDED for windows to send to the model.
+        """
+        return self._lookup(self._window_keys(window_ids))
+
+    def decide(self, ids, token_idxes):
+        """
+        Decide the candidates of a sequence of token ids.
+
+        Args:
+            ids (np.ndarray): Token IDs, with at least max(offsets) tokens
+                on either side of each candidate.
+            token_idxes (np.ndarray): Token indexes of the candidates.
+
+        Returns:
+            np.ndarray: 1 for a sentence end, 0 for no sentence end, and
+            UNDECIDED for candidates to send to the model.
+        """
+        contexts = np.stack(
+            [ids[token_idxes + offset] for offset in self.offsets], axis=1
+        )
+        decisions = self._lookup(self._keys(contexts.astype(np.int64)))
+        with self._lock:
+            self.candidates += len(decisions)
+            self.skipped += int(np.count_nonzero(decisions != UNDECIDED))
+        return decisions
+
+    def save(self, path):
+        np.savez(
+            path,
+            offsets=np.array(self.offsets),
+            vocab_size=self.vocab_size,
+            keys=self.keys,
+            decisions=self.decisions,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(
+                arrays["offsets"],
+                arrays["vocab_size"],
+                arrays["keys"],
+                arrays["decisions"],
+            )
+
+
+def evaluate(cascade, window_ids, labels, probs, threshold):
+    """
+    Measure how many candidates a cascade skips and its effect on accuracy.
+
+    Args:
+        cascade (Cascade): The cascade.
+        window_ids (np.ndarray): Validation context windows.
+        labels (np.ndarray): Label of each window.
+        probs (np.ndarray): Probability the model gives each window.
+        threshold (float): Decision threshold of the model.
+
+    Returns:
+        dict: The fraction of skipped candidates, the accuracy of the rules
+        on them, and the F1 score of the model alone and with the cascade.
+    """
+    from train import calculate_metrics
+
+    labels = np.asarray(labels, dtype=np.float32)
+    decisions = cascade.decide_windows(window_ids)
+    decided = decisions != UNDECIDED
+    model_preds = (probs > threshold).astype(np.float32)
+    cascade_preds = np.where(decided, decisions, model_preds)
+
+    model_metrics = calculate_metrics(model_preds, labels)
+    cascade_metrics = calculate_metrics(
+        cascade_preds.astype(np.float32), labels
+    )
+    return {
+        "rules": len(cascade.keys),
+        "skipped": float(np.mean(decided)),
+        "rule_accuracy": float(
+            np.mean(decisions[decided] == labels[decided])
+            if decided.any()
+            else 1.0
+        ),
+        "model_f1": model_metrics["F1 Score"],
+        "cascade_f1": cascade_metrics["F1 Score"],
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Learn the rules of the cascade run before the model."
+    )
+    parser.add_argument(
+        "--offsets",
+        type=int,
+        nargs="+",
+        default=list(DEFAULT_OFFSETS),
+        help="Token offsets from the candidate matched by the rules.",
+    )
+    parser.add_argument("--min-support", type=int, default=50)
+    parser.add_argument("--min-precision", type=float, default=0.999)
+    return parser.parse_args()
+
+
+def main():
+    from tokenizers import Tokenizer
+
+    import backends
+    import text_dataset
+    import thresholds
+
+    args = parse_args()
+
+    train_files = [
+        "../data/sbd_adjudicatory_dec/data_set/intellectual_property.json",
+        "../data/sbd_adjudicatory_dec/data_set/bva.json",
+        "../data/sbd_adjudicatory_dec/data_set/scotus.json",
+    ]
+
+    val_files = [
+        "../data/sbd_adjudicatory_dec/data_set/cyber_crime.json",
+    ]
+
+    tokenizer = Tokenizer.from_file(f"{ARTIFACTS_DIR}/tokenizer.json")
+    train_dataset = text_dataset.TextDataset.from_files(train_files, tokenizer)
+    val_dataset = text_dataset.TextDataset.from_files(val_files, tokenizer)
+
+    cascade = Cascade.fit(
+        train_dataset.window_ids,
+        train_dataset.windows_labels,
+        tokenizer.get_vocab_size(),
+        args.offsets,
+        args.min_support,
+        args.min_precision,
+    )
+
+    model = backends.load_model(ARTIFACTS_DIR)
+    probs, labels = thresholds.cached_probabilities(model, val_dataset)
+    report = evaluate(
+        cascade,
+        val_dataset.window_ids,
+        labels,
+        probs,
+        thresholds.load_threshold(ARTIFACTS_DIR),
+    )
+    cascade.save(Path(ARTIFACTS_DIR) / CASCADE_FILE)
+
+    print(
+        f"{report['rules']} rules skip {report['skipped']:.2%} of validation "
+        f"candidates with {report['rule_accuracy']:.4%} accuracy"
+    )
+    print(
+        f"val f1: {report['model_f1']:.4f} with the model alone, "
+        f"{report['cascade_f1']:.4f} with the cascade"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,9 @@ class CNNModel(nn.Module):
         hidden_dim: int = 128,
     ):
         super(CNNModel, self).__init__()
+        self.context_window = context_window
+        # Number of conv outputs per context window
+        self.conv_positions = (context_window * 2 + 1) - kernel_size + 1
         self.embedding = nn.Embedding(
             num_embeddings=vocab_size, embedding_dim=embedding_size
         )
@@ -22,7 +25,7 @@ class CNNModel(nn.Module):
             kernel_size=kernel_size,
         )
         self.fc1 = nn.Linear(
-            ((context_window * 2 + 1) - kernel_size + 1) * conv_out_channels,
+            self.conv_positions * conv_out_channels,
             hidden_dim,
         )
         self.fc2 = nn.Linear(hidden_dim, 1)
@@ -40,6 +43,43 @@ class CNNModel(nn.Module):
         output = torch.sigmoid(x)
         return output
 
+    def forward_document(self, ids, token_idxes):
+        """
+        Score candidate tokens of a whole document in a single pass.
+
+        Equivalent to calling forward on the context windows centred on
+        token_idxes, but the embedding and convolution are computed once over
+        the full sequence and the conv features are gathered at each
+        candidate, instead of being recomputed for every overlapping window.
+
+        Args:
+            ids (torch.Tensor): 1D tensor of token ids of the document,
+                padded by context_window on both sides.
+            token_idxes (torch.Tensor): 1D tensor with the indexes of the
+                candidate tokens.
+
+        Returns:
+            torch.Tensor: Tensor of shape (len(token_idxes), 1) with the
+            predicted probabilities.
+        """
+        if token_idxes.numel() == 0:
+            return torch.empty((0, 1))
+
+        x = self.embedding(ids.unsqueeze(0)).permute(0, 2, 1)
+        x = self.conv1d(x)
+        # Each window covers conv_positions consecutive conv outputs, starting
+        # at the first token of the window
+        starts = token_idxes.long() - self.context_window
+        positions = starts.unsqueeze(1) + torch.arange(self.conv_positions)
+        x = x[0][:, positions]
+        x = x.permute(1, 0, 2).reshape(token_idxes.numel(), -1)
+        x = self.fc1(x)
+        x = self.relu(x)
+        x = self.dropout(x)
+        x = self.fc2(x)
+        output = torch.sigmoid(x)
+        return output
+
 
 if __name__ == "__main__":
     model = CNNModel(vocab_size=300)
@@ -0,0 +1,332 @@
+import argparse
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from tokenizers import Tokenizer
+
+import backends
+import cnn
+import sweep
+import text_dataset
+import thresholds
+
+ARTIFACTS_DIR = "./artifacts"
+COMPRESSED_DIR = "./compressed"
+# Students keep the vocabulary and the context window of the teacher, so
+# they score the same windows with the same tokenizer
+DEFAULT_STUDENTS = [
+    {"conv_out_channels": 4, "hidden_dim": 64},
+    {"conv_out_channels": 4, "hidden_dim": 32},
+    {"embedding_size": 32, "conv_out_channels": 4, "hidden_dim": 16},
+]
+DEFAULT_PRUNE_AMOUNTS = [0.5, 0.75, 0.9]
+
+
+def _soften(probs, temperature):
+    return torch.sigmoid(torch.logit(probs, eps=1e-6) / temperature)
+
+
+def distill(
+    student,
+    teacher,
+    dataloader,
+    num_epochs,
+    temperature=2.0,
+    alpha=0.5,
+    lr=0.001,
+):
+    """
+    Train a student model to match the predictions of a teacher.
+
+    The loss mixes the binary cross-entropy with the labels and with the
+    teacher's probabilities, both softened by a temperature applied to the
+    logits.
+
+    Args:
+        student (CNNModel): The model to train.
+        teacher (CNNModel): The trained model to learn from.
+        dataloader (DataLoader): Batches of training windows and labels.
+        num_epochs (int): Number of epochs.
+        temperature (float): Temperature of the soft targets.
+        alpha (float): Weight of the loss on the labels, the loss on the
+            teacher's probabilities has weight 1 - alpha.
+        lr (float): Learning rate.
+    """
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr)
+    criterion = torch.nn.BCELoss()
+    teacher.eval()
+
+    for _ in range(num_epochs):
+        student.train()
+        for batch, labels in dataloader:
+            with torch.no_grad():
+                soft_targets = _soften(teacher(batch), temperature)
+
+            predictions = student(batch)
+            hard_loss = criterion(predictions, labels.view(-1, 1))
+            soft_loss = criterion(
+                _soften(predictions, temperature), soft_targets
+            )
+            loss = alpha * hard_loss + (1 - alpha) * temperature**2 * soft_loss
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+
+def prune_fc1(model, config, amount):
+    """
+    Remove the hidden units of fc1 with the smallest L1 norm.
+
+    The units are removed from fc1 and from the inputs of fc2, so the pruned
+    model is a smaller CNNModel rather than a masked one, and is as fast as a
+    model trained with its hidden_dim.
+
+    Args:
+        model (CNNModel): The model to prune.
+        config (dict): CNNModel arguments of the model.
+        amount (float): Fraction of the hidden units to remove.
+
+    Returns:
+        tuple: The pruned model and its CNNModel arguments.
+    """
+    weight = model.fc1.weight.detach()
+    num_units = max(1, round(weight.shape[0] * (1 - amount)))
+    keep = weight.abs().sum(dim=1).topk(num_units).indices.sort().values
+
+    config = {**config, "hidden_dim": num_units}
+    pruned = cnn.CNNModel(**config)
+    state_dict = model.state_dict()
+    state_dict["fc1.weight"] = state_dict["fc1.weight"][keep]
+    state_dict["fc1.bias"] = state_dict["fc1.bias"][keep]
+    state_dict["fc2.weight"] = state_dict["fc2.weight"][:, keep]
+    pruned.load_state_dict(state_dict)
+    return pruned, config
+
+
+def _num_parameters(model):
+    return sum(parameter.numel() for parameter in model.parameters())
+
+
+def evaluate_variant(model, val_dataset, num_threads=1):
+    """
+    Measure the accuracy and the throughput of a model.
+
+    Args:
+        model (CNNModel): The model.
+        val_dataset (TextDataset): The validation set.
+        num_threads (int): Number of torch threads for the throughput.
+
+    Returns:
+        dict: The F1 score at 0.5 and at the best threshold, the best
+        threshold, the throughput in windows per second and the number of
+        parameters.
+    """
+    probs, labels = thresholds.cached_probabilities(model, val_dataset)
+    curve = thresholds.sweep(probs, labels)
+    threshold, metrics = thresholds.best_threshold(curve)
+    default = int(
+        np.argmin(np.abs(curve["Threshold"] - thresholds.DEFAULT_THRESHOLD))
+    )
+
+    threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        latency_ms = sweep.measure_latency(model, val_dataset.window_ids)
+    finally:
+        torch.set_num_threads(threads)
+
+    return {
+        "f1": float(curve["F1 Score"][default]),
+        "tuned_f1": metrics["f1"],
+        "threshold": threshold,
+        "windows_per_second": 1e6 / latency_ms,
+        "parameters": _num_parameters(model),
+    }
+
+
+def save_variant(model, config, tokenizer, threshold, variant_dir):
+    """
+    Write a variant as a complete set of model artifacts.
+
+    Args:
+        model (CNNModel): The model.
+        config (dict): CNNModel arguments of the model.
+        tokenizer (Tokenizer): The tokenizer of the model.
+        threshold (float): The tuned decision threshold.
+        variant_dir (Path): Directory to write the artifacts to.
+    """
+    variant_dir.mkdir(parents=True, exist_ok=True)
+    torch.save(model.state_dict(), variant_dir / backends.ARTIFACTS["eager"])
+    backends.save_config(variant_dir, config)
+    tokenizer.save(str(variant_dir / "tokenizer.json"))
+    thresholds.save_threshold(variant_dir, threshold)
+
+
+def compress(
+    teacher,
+    teacher_config,
+    tokenizer,
+    train_dataset,
+    val_dataset,
+    args,
+):
+    """
+    Distill and prune a trained model, and compare the variants.
+
+    Args:
+        teacher (CNNModel): The trained model.
+        teacher_config (dict): CNNModel arguments of the trained model.
+        tokenizer (Tokenizer): The tokenizer of the trained model.
+        train_dataset (TextDataset): The training set.
+        val_dataset (TextDataset): The validation set.
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        list: One dict per variant with its name, arguments, metrics and
+        the directory of its artifacts.
+    """
+    output_dir = Path(args.output)
+    dataloader = text_dataset.batch_dataloader(
+        train_dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+    )
+
+    variants = [("teacher", teacher, teacher_config)]
+    for i, student_config in enumerate(args.students):
+        config = {**teacher_config, **student_config}
+        for name in ("vocab_size", "context_window"):
+            if config[name] != teacher_config[name]:
+                raise ValueError(f"Students must keep the teacher's {name}")
+        torch.manual_seed(args.seed)
+        student = cnn.CNNModel(**config)
+        start = time.perf_counter()
+        distill(student, teacher, dataloader, args.epochs)
+        print(
+            f"distilled student-{i} in {time.perf_counter() - start:.1f}s: "
+            f"{student_config}"
+        )
+        variants.append((f"student-{i}", student, config))
+
+    for amount in args.prune:
+        pruned, config = prune_fc1(teacher, teacher_config, amount)
+        # Recover the accuracy lost to pruning by distilling the teacher
+        # into the pruned model
+        distill(pruned, teacher, dataloader, args.fine_tune_epochs)
+        print(f"pruned {amount:.0%} of fc1 to {config['hidden_dim']} units")
+        variants.append((f"pruned-{amount:g}", pruned, config))
+
+    report = []
+    for name, model, config in variants:
+        metrics = evaluate_variant(model, val_dataset, args.threads)
+        variant_dir = output_dir / name
+        save_variant(
+            model, config, tokenizer, metrics["threshold"], variant_dir
+        )
+        report.append(
+            {
+                "name": name,
+                "config": config,
+                **metrics,
+                "path": str(variant_dir),
+            }
+        )
+
+    with open(output_dir / "report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Distill and prune the trained model, comparing the "
+        "throughput and F1 of the variants."
+    )
+    parser.add_argument(
+        "--students",
+        type=json.loads,
+        default=DEFAULT_STUDENTS,
+        help="JSON list of CNNModel arguments of the students, overriding "
+        "those of the teacher.",
+    )
+    parser.add_argument(
+        "--prune",
+        type=float,
+        nargs="*",
+        default=DEFAULT_PRUNE_AMOUNTS,
+        help="Fractions of the fc1 hidden units to prune from the teacher.",
+    )
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument(
+        "--fine-tune-epochs",
+        type=int,
+        default=1,
+        help="Number of epochs distilling the teacher into a pruned model.",
+    )
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of torch threads used to measure throughput.",
+    )
+    parser.add_argument(
+        "--output",
+        default=COMPRESSED_DIR,
+        help="Directory to write the variants and report.json to.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    train_files = [
+        "../data/sbd_adjudicatory_dec/data_set/intellectual_property.json",
+        "../data/sbd_adjudicatory_dec/data_set/bva.json",
+        "../data/sbd_adjudicatory_dec/data_set/scotus.json",
+    ]
+
+    val_files = [
+        "../data/sbd_adjudicatory_dec/data_set/cyber_crime.json",
+    ]
+
+    teacher = backends.load_model(ARTIFACTS_DIR)
+    teacher_config = {
+        **sweep.HYPERPARAMETERS,
+        **backends.load_config(ARTIFACTS_DIR),
+    }
+    tokenizer = Tokenizer.from_file(f"{ARTIFACTS_DIR}/tokenizer.json")
+    padding = teacher_config["context_window"]
+    train_dataset = text_dataset.TextDataset.from_files(
+        train_files, tokenizer, padding=padding
+    )
+    val_dataset = text_dataset.TextDataset.from_files(
+        val_files, tokenizer, padding=padding
+    )
+
+    report = compress(
+        teacher, teacher_config, tokenizer, train_dataset, val_dataset, args
+    )
+
+    print(
+        f"{'variant':<14} {'params':>8} {'windows/s':>11} {'f1':>8} "
+        f"{'tuned f1':>9}"
+    )
+    for variant in report:
+        print(
+            f"{variant['name']:<14} {variant['parameters']:>8} "
+            f"{variant['windows_per_second']:>11.0f} {variant['f1']:>8.4f} "
+            f"{variant['tuned_f1']:>9.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
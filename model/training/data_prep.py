@@ -1,5 +1,11 @@
+import hashlib
 import json
-from typing import Any, NamedTuple
+import multiprocessing
+import os
+import queue
+import tempfile
+from pathlib import Path
+from typing import Any, Iterable, Iterator, NamedTuple, TextIO
 
 from tokenizers import Regex, Tokenizer, models, pre_tokenizers, trainers
 from tokenizers.models import BPE
@@ -9,6 +15,11 @@ from tokenizers.trainers import BpeTrainer
 TEXT = "text"
 ANNOTATIONS = "annotations"
 END = "end"
+SPECIAL_TOKENS = ["[UNK]", "[PAD]"]
+CACHE_DIR = "./cache"
+READ_SIZE = 1 << 20
+# Records are sent from the reader processes in batches of RECORD_BATCH_SIZE
+RECORD_BATCH_SIZE = 64
 
 
 class ProcessedData(NamedTuple):
@@ -33,14 +44,26 @@ def process_data(
     all_ends = []
 
     for key in data:
-        text: str = data[key][TEXT]
+        text, sentence_ends = process_record(data[key])
         texts.append(text)
-        sentence_ends = extract_ends(data[key][ANNOTATIONS])
         all_ends.append(sentence_ends)
 
     return texts, all_ends
 
 
+def process_record(record: dict[str, Any]) -> tuple[str, tuple[int, ...]]:
+    """
+    Extract the text and sentence ends of a single record.
+
+    Args:
+        record: A dictionary containing text and annotations.
+
+    Returns:
+        A tuple containing the text and a tuple with its sentence ends.
+    """
+    return record[TEXT], extract_ends(record[ANNOTATIONS])
+
+
 def extract_ends(annotations: list[dict[str, int]]) -> tuple[int, ...]:
     """
     Extract sentence ends from a list of annotations.
@@ -57,6 +80,227 @@ def extract_ends(annotations: list[dict[str, int]]) -> tuple[int, ...]:
     return tuple(sorted(sentence_ends))
 
 
+class _JsonObjectReader:
+    def __init__(self, f: TextIO, read_size: int = READ_SIZE):
+        """
+        Incrementally parse the items of a top-level JSON object.
+
+        Only the item being parsed is held in memory, rather than the whole
+        parsed file.
+
+        Args:
+            f: Text file containing a JSON object.
+            read_size: Number of characters to read at a time.
+        """
+        self.f = f
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self) -> Iterator[tuple[str, Any]]:
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._decode()
+            self._expect(":")
+            yield key, self._decode()
+            char = self._peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or '}}', got {char!r}")
+
+    def _fill(self):
+        # Read at least as much as is already buffered, so that a value
+        # larger than read_size is re-decoded a logarithmic number of times
+        chunk = self.f.read(max(self.read_size, len(self.buffer) - self.pos))
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+
+    def _peek(self) -> str:
+        while True:
+            while (
+                self.pos < len(self.buffer)
+                and self.buffer[self.pos] in " \t\n\r"
+            ):
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r}, got {self._peek()!r}")
+        self.pos += 1
+
+    def _decode(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # A number at the end of the buffer may continue in the file
+            if end < len(self.buffer) or self.eof:
+                self.pos = end
+                return value
+            self._fill()
+
+
+def iter_records_from_json_file(
+    file_path: str,
+) -> Iterator[tuple[str, tuple[int, ...]]]:
+    """
+    Stream the texts and sentence ends from a JSON file, one at a time.
+
+    Args:
+        file_path: Path to a JSON file.
+
+    Yields:
+        A tuple containing a text and a tuple with its sentence ends.
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        try:
+            for _, record in _JsonObjectReader(f):
+                yield process_record(record)
+        except ValueError as e:
+            raise ValueError(f"Failed to parse {file_path}: {e}") from e
+
+
+def _stream_file(file_path: str, records: multiprocessing.Queue):
+    """
+    Send the records of a JSON file to a queue, in batches.
+
+    Once the file is read, None is sent, or the exception if reading fails.
+    """
+    try:
+        batch = []
+        for record in iter_records_from_json_file(file_path):
+            batch.append(record)
+            if len(batch) == RECORD_BATCH_SIZE:
+                records.put(batch)
+                batch = []
+        if batch:
+            records.put(batch)
+        records.put(None)
+    except Exception as e:
+        records.put(e)
+
+
+def _get_batch(records: multiprocessing.Queue, reader) -> Any:
+    """Get a batch from a reader process, failing if the reader died."""
+    while True:
+        try:
+            return records.get(timeout=1)
+        except queue.Empty:
+            if not reader.is_alive():
+                try:
+                    return records.get(timeout=1)
+                except queue.Empty:
+                    raise RuntimeError(
+                        f"Reader process exited with code {reader.exitcode}"
+                    )
+
+
+def iter_records_from_json_files(
+    file_paths: list[str], processes: int | None = None
+) -> Iterator[tuple[str, tuple[int, ...]]]:
+    """
+    Stream the texts and sentence ends from JSON files.
+
+    The files are parsed in parallel, each in its own process, with up to
+    `processes` running at a time. Records are yielded in file order, and
+    readers parse their whole file ahead of the file being yielded. A
+    reader only exits once its records are taken from its queue, so at
+    most `processes` files are held in memory.
+
+    Args:
+        file_paths: A list of file paths to JSON files.
+        processes: Maximum number of reader processes, defaults to the
+            number of CPUs. With 1, the files are read in this process.
+
+    Yields:
+        A tuple containing a text and a tuple with its sentence ends.
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    if processes <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield from iter_records_from_json_file(file_path)
+        return
+
+    queues = [multiprocessing.Queue() for _ in file_paths]
+    readers = [
+        multiprocessing.Process(
+            target=_stream_file, args=(file_path, records), daemon=True
+        )
+        for file_path, records in zip(file_paths, queues)
+    ]
+    num_started = 0
+    try:
+        for reader, records in zip(readers, queues):
+            while num_started < len(readers) and (
+                sum(r.is_alive() for r in readers[:num_started]) < processes
+            ):
+                readers[num_started].start()
+                num_started += 1
+            while (batch := _get_batch(records, reader)) is not None:
+                if isinstance(batch, Exception):
+                    raise batch
+                yield from batch
+            reader.join()
+    finally:
+        for reader in readers[:num_started]:
+            if reader.is_alive():
+                reader.terminate()
+
+
+class JsonCorpus:
+    def __init__(
+        self,
+        file_paths: list[str],
+        processes: int | None = None,
+        texts_only: bool = False,
+    ):
+        """
+        Re-iterable stream of the records in JSON files.
+
+        Each iteration streams the records from the files again, so the
+        corpus can be passed where more than one pass is needed without
+        holding it in memory.
+
+        Args:
+            file_paths: A list of file paths to JSON files.
+            processes: Maximum number of reader processes.
+            texts_only: Whether to yield only the texts rather than tuples
+                of texts and sentence ends.
+        """
+        self.file_paths = file_paths
+        self.processes = processes
+        self.texts_only = texts_only
+
+    @property
+    def texts(self) -> "JsonCorpus":
+        """The corpus, yielding only the texts."""
+        return JsonCorpus(self.file_paths, self.processes, texts_only=True)
+
+    def __iter__(self) -> Iterator:
+        records = iter_records_from_json_files(self.file_paths, self.processes)
+        if self.texts_only:
+            return (text for text, _ in records)
+        return records
+
+
 def read_texts_from_json_files(file_paths: list[str]) -> ProcessedData:
     """
     Read texts from JSON files and process the data.
@@ -69,12 +313,9 @@ def read_texts_from_json_files(file_paths: list[str]) -> ProcessedData:
     """
     all_texts = []
     all_ends = []
-    for file_path in file_paths:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            texts, ends = process_data(data)
-            all_texts += texts
-            all_ends += ends
+    for text, ends in iter_records_from_json_files(file_paths):
+        all_texts.append(text)
+        all_ends.append(ends)
 
     processed_data = ProcessedData(
         texts=tuple(all_texts), ends=tuple(all_ends)
@@ -82,21 +323,28 @@ def read_texts_from_json_files(file_paths: list[str]) -> ProcessedData:
     return processed_data
 
 
-def prep_tokenizer(texts: tuple[str, ...], vocab_size=300) -> Tokenizer:
+def prep_tokenizer(
+    texts: Iterable[str], vocab_size=300, cache_dir: str | None = CACHE_DIR
+) -> Tokenizer:
     """
     Prepare a tokenizer for the given texts.
 
+    The trained tokenizer is cached by a hash of the texts, the vocabulary
+    size and the tokenizer configuration, so it is only retrained when one
+    of them changes. With a cache, texts is iterated twice, so it should be
+    a sequence or a JsonCorpus rather than an iterator.
+
     Args:
-        texts: A tuple of texts to train the tokenizer.
+        texts: Texts to train the tokenizer.
         vocab_size: The vocabulary size for the tokenizer.
+        cache_dir: Directory of the tokenizer cache, or None to always train
+            the tokenizer.
 
     Returns:
         A Tokenizer object ready for tokenization.
     """
     tokenizer = Tokenizer(BPE(unk_token="[UNK]"))
-    trainer = BpeTrainer(
-        vocab_size=vocab_size, special_tokens=["[UNK]", "[PAD]"]
-    )
+    trainer = BpeTrainer(vocab_size=vocab_size, special_tokens=SPECIAL_TOKENS)
     # Define the sequence of pre-tokenizers
     tokenizer.pre_tokenizer = Sequence(
         [
@@ -112,10 +360,48 @@ def prep_tokenizer(texts: tuple[str, ...], vocab_size=300) -> Tokenizer:
         ]
     )
 
+    if cache_dir is None:
+        tokenizer.train_from_iterator(texts, trainer=trainer)
+        return tokenizer
+
+    key = _tokenizer_cache_key(tokenizer, texts, vocab_size)
+    cache_path = Path(cache_dir) / f"tokenizer-{key}.json"
+    if cache_path.exists():
+        return Tokenizer.from_file(str(cache_path))
+
     tokenizer.train_from_iterator(texts, trainer=trainer)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".json")
+    os.close(fd)
+    tokenizer.save(tmp_path)
+    os.replace(tmp_path, cache_path)
     return tokenizer
 
 
+def _tokenizer_cache_key(
+    tokenizer: Tokenizer, texts: Iterable[str], vocab_size: int
+) -> str:
+    """
+    Compute the cache key of a trained tokenizer.
+
+    Args:
+        tokenizer: The untrained tokenizer.
+        texts: The texts the tokenizer is trained on.
+        vocab_size: The vocabulary size for the tokenizer.
+
+    Returns:
+        A hash of the tokenizer configuration, vocabulary size, special
+        tokens and texts.
+    """
+    key = hashlib.sha256(tokenizer.to_str().encode("utf-8"))
+    key.update(json.dumps([vocab_size, SPECIAL_TOKENS]).encode("utf-8"))
+    for text in texts:
+        encoded = text.encode("utf-8")
+        key.update(len(encoded).to_bytes(8, "little"))
+        key.update(encoded)
+    return key.hexdigest()[:32]
+
+
 if __name__ == "__main__":
     file_paths = [
         "../data/sbd_adjudicatory_dec/data_set/intellectual_property.json",
@@ -0,0 +1,321 @@
+import argparse
+import itertools
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import torch
+
+import cnn
+import data_prep
+import text_dataset
+import thresholds
+import train
+
+SWEEP_DIR = "./sweep"
+# CNNModel arguments that can be swept, with the defaults of train.py
+HYPERPARAMETERS = {
+    "vocab_size": 300,
+    "embedding_size": 64,
+    "context_window": 6,
+    "kernel_size": 5,
+    "conv_out_channels": 6,
+    "hidden_dim": 128,
+}
+
+
+def expand_search_space(space):
+    """
+    List the configurations of a grid search space.
+
+    Args:
+        space (dict): Maps CNNModel arguments to a list of values to try.
+            Arguments that are not in the space keep their default value.
+
+    Returns:
+        list: One dict of CNNModel arguments per configuration.
+    """
+    unknown = set(space) - set(HYPERPARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown hyperparameters: {sorted(unknown)}")
+
+    names = list(space)
+    return [
+        {**HYPERPARAMETERS, **dict(zip(names, values))}
+        for values in itertools.product(*(space[name] for name in names))
+    ]
+
+
+def prepare_datasets(configs, train_files, val_files):
+    """
+    Build the datasets needed by the configurations of a sweep.
+
+    Configurations sharing a vocabulary size and a context window share one
+    tokenizer and one cached dataset, memory-mapped by every process that
+    trains on it.
+
+    Args:
+        configs (list): Configurations from expand_search_space.
+        train_files (list): JSON data files of the training set.
+        val_files (list): JSON data files of the validation set.
+
+    Returns:
+        tuple: The tokenizer of each vocab_size, and the training and
+        validation sets of each (vocab_size, context_window) pair.
+    """
+    texts = data_prep.JsonCorpus(train_files).texts
+    tokenizers = {}
+    datasets = {}
+    for config in configs:
+        vocab_size = config["vocab_size"]
+        context_window = config["context_window"]
+        if (vocab_size, context_window) in datasets:
+            continue
+        if vocab_size not in tokenizers:
+            tokenizers[vocab_size] = data_prep.prep_tokenizer(
+                texts, vocab_size=vocab_size
+            )
+        datasets[vocab_size, context_window] = tuple(
+            text_dataset.TextDataset.from_files(
+                file_paths, tokenizers[vocab_size], padding=context_window
+            )
+            for file_paths in (train_files, val_files)
+        )
+    return tokenizers, datasets
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def train_config(config, train_dataset, val_dataset, args):
+    """
+    Train and evaluate one configuration.
+
+    Args:
+        config (dict): CNNModel arguments.
+        train_dataset (TextDataset): The training set.
+        val_dataset (TextDataset): The validation set.
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        tuple: The state_dict of the trained model, and its validation
+        metrics.
+    """
+    torch.manual_seed(args.seed)
+    model = cnn.CNNModel(**config)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    criterion = torch.nn.BCELoss()
+
+    start = time.perf_counter()
+    train.train(
+        model,
+        text_dataset.batch_dataloader(
+            train_dataset, batch_size=args.batch_size, shuffle=True
+        ),
+        None,
+        optimizer,
+        criterion,
+        num_epochs=args.epochs,
+        verbose=False,
+    )
+    train_time = time.perf_counter() - start
+
+    probs, labels = thresholds.cached_probabilities(
+        model, val_dataset, cache_dir=None
+    )
+    curve = thresholds.sweep(probs, labels)
+    threshold, metrics = thresholds.best_threshold(curve)
+    default = int(
+        np.argmin(np.abs(curve["Threshold"] - thresholds.DEFAULT_THRESHOLD))
+    )
+    return model.state_dict(), {
+        "f1": float(curve["F1 Score"][default]),
+        "tuned_f1": metrics["f1"],
+        "threshold": threshold,
+        "train_seconds": train_time,
+    }
+
+
+def measure_latency(model, window_ids, num_candidates=4096, repeats=20):
+    """
+    Measure the time a model takes to score a document.
+
+    The document is made of validation context windows laid end to end, so
+    that every configuration scores the same candidates.
+
+    Args:
+        model (CNNModel): The model.
+        window_ids (np.ndarray): Validation context windows.
+        num_candidates (int): Number of candidates in the document.
+        repeats (int): Number of timed runs.
+
+    Returns:
+        float: Median time in milliseconds per 1000 candidates.
+    """
+    window_ids = np.array(window_ids[:num_candidates])
+    window_size = window_ids.shape[1]
+    ids = torch.from_numpy(window_ids.ravel())
+    token_idxes = (
+        torch.arange(len(window_ids)) * window_size + window_size // 2
+    )
+
+    model.eval()
+    times = []
+    with torch.no_grad():
+        model.forward_document(ids, token_idxes)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.forward_document(ids, token_idxes)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e3 * 1000 / len(window_ids)
+
+
+def run_sweep(space, train_files, val_files, args):
+    """
+    Train the configurations of a search space concurrently.
+
+    Each configuration is trained in its own process of a pool, with the
+    cores split between the processes. Latencies are measured afterwards,
+    one model at a time, so that they do not compete for cores.
+
+    Args:
+        space (dict): Search space, see expand_search_space.
+        train_files (list): JSON data files of the training set.
+        val_files (list): JSON data files of the validation set.
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        list: One dict per configuration with its arguments, metrics,
+        latency and the paths of its saved state_dict and tokenizer.
+    """
+    configs = expand_search_space(space)
+    tokenizers, datasets = prepare_datasets(configs, train_files, val_files)
+    sweep_dir = Path(args.output)
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+
+    num_threads = max(1, os.cpu_count() // args.processes)
+    with ProcessPoolExecutor(
+        max_workers=args.processes,
+        initializer=_init_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                train_config,
+                config,
+                *datasets[config["vocab_size"], config["context_window"]],
+                args,
+            )
+            for config in configs
+        ]
+
+        trained = []
+        for i, future in enumerate(futures):
+            trained.append(future.result())
+            print(f"trained {i + 1}/{len(configs)}: {configs[i]}")
+
+    torch.set_num_threads(args.latency_threads)
+    results = []
+    for i, (config, (state_dict, metrics)) in enumerate(zip(configs, trained)):
+        path = sweep_dir / f"model-{i}.pt"
+        torch.save(state_dict, path)
+        _, val_dataset = datasets[
+            config["vocab_size"], config["context_window"]
+        ]
+        tokenizer_path = sweep_dir / f"tokenizer-{config['vocab_size']}.json"
+        tokenizers[config["vocab_size"]].save(str(tokenizer_path))
+
+        model = cnn.CNNModel(**config)
+        model.load_state_dict(state_dict)
+        results.append(
+            {
+                "config": config,
+                **metrics,
+                "latency_ms": measure_latency(model, val_dataset.window_ids),
+                "path": str(path),
+                "tokenizer": str(tokenizer_path),
+            }
+        )
+
+    with open(sweep_dir / "results.json", "w") as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Train CNNModel configurations concurrently."
+    )
+    parser.add_argument(
+        "space",
+        help="JSON file mapping CNNModel arguments to lists of values, e.g. "
+        '{"hidden_dim": [32, 128], "context_window": [4, 6]}.',
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=4,
+        help="Number of configurations trained at a time.",
+    )
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency-threads",
+        type=int,
+        default=1,
+        help="Number of torch threads used to measure inference latency.",
+    )
+    parser.add_argument(
+        "--min-f1",
+        type=float,
+        default=0.0,
+        help="Validation F1 the recommended configuration must reach.",
+    )
+    parser.add_argument(
+        "--output",
+        default=SWEEP_DIR,
+        help="Directory to write the models and results.json to.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with open(args.space, "r") as f:
+        space = json.load(f)
+
+    train_files = [
+        "../data/sbd_adjudicatory_dec/data_set/intellectual_property.json",
+        "../data/sbd_adjudicatory_dec/data_set/bva.json",
+        "../data/sbd_adjudicatory_dec/data_set/scotus.json",
+    ]
+
+    val_files = [
+        "../data/sbd_adjudicatory_dec/data_set/cyber_crime.json",
+    ]
+
+    results = run_sweep(space, train_files, val_files, args)
+
+    print(f"{'latency (ms/1k)':>16} {'f1':>8} {'tuned f1':>9}  config")
+    for result in sorted(results, key=lambda result: result["latency_ms"]):
+        print(
+            f"{result['latency_ms']:16.3f} {result['f1']:8.4f} "
+            f"{result['tuned_f1']:9.4f}  {json.dumps(result['config'])}"
+        )
+
+    eligible = [result for result in results if result["f1"] >= args.min_f1]
+    if eligible:
+        fastest = min(eligible, key=lambda result: result["latency_ms"])
+        print(f"fastest with f1 >= {args.min_f1}: {fastest['path']}")
+    else:
+        print(f"no configuration reaches f1 >= {args.min_f1}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,21 @@
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from numpy.lib.stride_tricks import sliding_window_view
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+TARGET_TOKENS = [".", '"', "]", ")", ":", '"', "'", "*", ">", ";"]
+
+CACHE_DIR = "./cache"
+ENCODE_BATCH_SIZE = 256
+WINDOW_IDS_FILE = "window_ids.npy"
+LABELS_FILE = "labels.npy"
 
 
 class TextDataset(Dataset):
@@ -8,49 +24,181 @@ class TextDataset(Dataset):
         Initialize the TextDataset with texts, ends, tokenizer, padding, and
         device.
 
+        The windows and labels are stored as contiguous int32 and uint8
+        arrays, the encodings of the texts are discarded once their windows
+        are extracted.
+
         Args:
             texts (list): List of texts to be encoded.
             ends (list): List of end positions for labels.
             tokenizer (object): Tokenizer to encode the texts.
-            padding (int): Padding size for the encoded texts.
+            padding (int): Padding size for the encoded texts, which is also
+                the context size of the windows.
             device (str): Device to be used for torch tensors.
         """
         self.texts = texts
         self.ends = ends
+        self._build(zip(texts, ends), tokenizer, padding, device)
+
+    @classmethod
+    def from_records(cls, records, tokenizer, padding=6, device="cpu"):
+        """
+        Build a dataset from a stream of texts and their sentence ends.
+
+        The records are consumed one batch at a time, so they do not need to
+        be held in memory.
+
+        Args:
+            records (iterable): Tuples of a text and its end positions.
+            tokenizer (object): Tokenizer to encode the texts.
+            padding (int): Padding size for the encoded texts.
+            device (str): Device to be used for torch tensors.
+
+        Returns:
+            TextDataset: The dataset.
+        """
+        dataset = cls.__new__(cls)
+        dataset.texts = None
+        dataset.ends = None
+        dataset._build(records, tokenizer, padding, device)
+        return dataset
+
+    def _build(self, records, tokenizer, padding, device):
         self.tokenizer = tokenizer
         self.device = device
-        self.encoded_texts, self.labels = self._encode(
-            texts, ends, tokenizer, padding
-        )
+        self.path = None
         self.window_ids, self.windows_labels = self._extract_contexts(
-            self.encoded_texts, self.labels
+            self._encode(records, tokenizer, padding), context_size=padding
         )
 
-    def _encode(self, train_texts, ends, tokenizer, padding):
+    @classmethod
+    def from_files(
+        cls,
+        file_paths,
+        tokenizer,
+        padding=6,
+        device="cpu",
+        cache_dir=CACHE_DIR,
+        records=None,
+    ):
         """
-        Encode the texts and generate labels.
+        Load a dataset from the cache, building and caching it on a miss.
+
+        The cache is keyed by the tokenizer, the input files and the padding,
+        and is memory-mapped when loaded so the windows are not copied.
 
         Args:
-            train_texts (list): List of texts to be encoded.
-            ends (list): List of end positions for labels.
+            file_paths (list): List of paths to the JSON data files.
             tokenizer (object): Tokenizer to encode the texts.
             padding (int): Padding size for the encoded texts.
+            device (str): Device to be used for torch tensors.
+            cache_dir (str): Directory of the dataset cache.
+            records (iterable): Texts and end positions read from
+                file_paths, used on a cache miss. Defaults to streaming them
+                from the files.
 
         Returns:
-            tuple: A tuple containing encoded texts and labels.
+            TextDataset: The dataset.
         """
-        encoded_texts = []
-        labels = []
-        pad_id = tokenizer.token_to_id("[PAD]")
+        path = Path(cache_dir) / _cache_key(tokenizer, file_paths, padding)
+        if not path.exists():
+            if records is None:
+                import data_prep
+
+                records = data_prep.JsonCorpus(file_paths)
+            dataset = cls.from_records(records, tokenizer, padding, device)
+            dataset.save(path)
+        return cls.load(path, device)
+
+    @classmethod
+    def load(cls, path, device="cpu"):
+        """
+        Load a dataset saved with save, memory-mapping its arrays.
 
-        for i, text in enumerate(train_texts):
-            encoded = tokenizer.encode(text)
-            self._pad_encoded_text(encoded, padding, pad_id)
-            encoded_texts.append(encoded)
-            _, labeled_tokens = _label_tokens(encoded.offsets, ends[i])
-            labels.append(labeled_tokens)
+        Args:
+            path (str): Directory the dataset was saved to.
+            device (str): Device to be used for torch tensors.
+
+        Returns:
+            TextDataset: The dataset.
+        """
+        path = Path(path)
+        dataset = cls.__new__(cls)
+        dataset.texts = None
+        dataset.ends = None
+        dataset.tokenizer = None
+        dataset.device = device
+        dataset.path = path
+        dataset._load_arrays()
+        return dataset
+
+    def _load_arrays(self):
+        self.window_ids = np.load(self.path / WINDOW_IDS_FILE, mmap_mode="r")
+        self.windows_labels = np.load(self.path / LABELS_FILE, mmap_mode="r")
+
+    def __getstate__(self):
+        # A cached dataset is pickled by path, e.g. for spawned DataLoader
+        # workers, so that each worker memory-maps the same files instead of
+        # receiving a copy of the arrays
+        state = self.__dict__.copy()
+        if self.path is not None:
+            del state["window_ids"], state["windows_labels"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self._load_arrays()
+
+    def save(self, path):
+        """
+        Save the windows and labels of the dataset.
 
-        return encoded_texts, labels
+        The files are written to a temporary directory which is then renamed,
+        so a dataset is never loaded from a partially written cache.
+
+        Args:
+            path (str): Directory to save the dataset to.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(tempfile.mkdtemp(dir=path.parent))
+        np.save(tmp_path / WINDOW_IDS_FILE, self.window_ids)
+        np.save(tmp_path / LABELS_FILE, self.windows_labels)
+        try:
+            tmp_path.rename(path)
+        except OSError:
+            # Another process saved the same dataset first
+            shutil.rmtree(tmp_path)
+
+    def _encode(self, records, tokenizer, padding):
+        """
+        Encode the texts and generate labels.
+
+        Args:
+            records (iterable): Tuples of a text and its end positions.
+            tokenizer (object): Tokenizer to encode the texts.
+            padding (int): Padding size for the encoded texts.
+
+        Yields:
+            tuple: A tuple containing the token ids and labels of each text.
+        """
+        pad_id = tokenizer.token_to_id("[PAD]")
+        records = iter(records)
+
+        # encode_batch tokenizes the texts in parallel, a batch at a time so
+        # that only ENCODE_BATCH_SIZE encodings are held in memory
+        while batch := list(itertools.islice(records, ENCODE_BATCH_SIZE)):
+            texts = [text for text, _ in batch]
+            for (_, ends), encoded in zip(
+                batch, tokenizer.encode_batch(texts)
+            ):
+                self._pad_encoded_text(encoded, padding, pad_id)
+                _, labeled_tokens = _label_tokens(encoded.offsets, ends)
+                yield (
+                    np.array(encoded.ids, dtype=np.int32),
+                    np.array(labeled_tokens, dtype=bool),
+                )
 
     def _pad_encoded_text(self, encoded, padding, pad_id):
         """
@@ -67,7 +215,6 @@ class TextDataset(Dataset):
     def _extract_contexts(
         self,
         encoded_texts,
-        labels,
         target_tokens=None,
         context_size=6,
     ):
@@ -75,8 +222,7 @@ class TextDataset(Dataset):
         Extract context windows and labels.
 
         Args:
-            encoded_texts (list): List of encoded texts.
-            labels (list): List of labels.
+            encoded_texts (iterable): Token ids and labels of each text.
             target_tokens (list): List of target tokens to consider for
                 context extraction.
             context_size (int): Size of the context window.
@@ -84,27 +230,22 @@ class TextDataset(Dataset):
         Returns:
             tuple: A tuple containing window IDs and window labels.
         """
-        if target_tokens is None:
-            target_tokens = [".", '"', "]", ")", ":", '"', "'", "*", ">", ";"]
-
-        window_ids = []
-        window_labels = []
-
-        for i, encoded_text in enumerate(encoded_texts):
-            tokens = encoded_text.tokens
-            num_tokens = len(tokens)
-            for j in range(num_tokens):
-                token = tokens[j]
-                if (
-                    (token in target_tokens)
-                    or _is_end_of_line(tokens, j)
-                    or labels[i][j]
-                ):
-                    start = max(0, j - context_size)
-                    end = min(len(encoded_text), j + context_size + 1)
-                    window_ids.append(encoded_text.ids[start:end])
-                    window_labels.append(labels[i][j])
-
+        target_ids = target_token_ids(self.tokenizer, target_tokens)
+        newline_id = self.tokenizer.token_to_id("\n")
+
+        window_ids = [np.empty((0, 2 * context_size + 1), dtype=np.int32)]
+        window_labels = [np.empty(0, dtype=np.uint8)]
+
+        for ids, labels in encoded_texts:
+            mask = candidate_mask(ids, target_ids, newline_id, context_size)
+            inner = slice(context_size, len(ids) - context_size)
+            mask[inner] |= labels[inner]
+            token_idxes = np.flatnonzero(mask)
+            window_ids.append(extract_windows(ids, token_idxes, context_size))
+            window_labels.append(labels[token_idxes].astype(np.uint8))
+
+        window_ids = np.concatenate(window_ids)
+        window_labels = np.concatenate(window_labels)
         return window_ids, window_labels
 
     def __len__(self):
@@ -113,45 +254,252 @@ class TextDataset(Dataset):
 
     def __getitem__(self, idx):
         """
-        Get the item at the specified index.
+        Get the item, or batch of items, at the specified index.
 
         Args:
-            idx (int): Index of the item to be retrieved.
+            idx (int or np.ndarray): Index of the item, or array of indexes
+                of the items to be retrieved.
 
         Returns:
-            tuple: A tuple containing window IDs and the corresponding label.
+            tuple: A tuple containing window IDs and the corresponding label,
+            stacked along the first dimension for an array of indexes.
         """
-        window_ids = torch.tensor(
-            self.window_ids[idx], dtype=torch.int32, device=self.device
-        )
-        label = torch.tensor(
-            self.windows_labels[idx], dtype=torch.float32, device=self.device
-        )
-        return window_ids, label
+        if np.ndim(idx) == 0:
+            window_ids = torch.tensor(
+                self.window_ids[idx], dtype=torch.int32, device=self.device
+            )
+            label = torch.tensor(
+                self.windows_labels[idx],
+                dtype=torch.float32,
+                device=self.device,
+            )
+            return window_ids, label
+
+        # Copied, torch cannot wrap the read-only memory-mapped windows
+        window_ids = torch.from_numpy(np.array(self.window_ids[idx]))
+        labels = torch.from_numpy(self.windows_labels[idx].astype(np.float32))
+        return window_ids.to(self.device), labels.to(self.device)
+
+
+class BatchIndexSampler(Sampler):
+    def __init__(
+        self,
+        num_items,
+        batch_size,
+        shuffle=False,
+        num_replicas=1,
+        rank=0,
+        seed=None,
+        drop_last=False,
+    ):
+        """
+        Sample whole batches of indexes at a time.
+
+        Used with DataLoader(batch_size=None), each batch is fetched from
+        the dataset with a single gather instead of one __getitem__ call and
+        collation per item.
+
+        For distributed training, every replica draws the same permutation
+        from seed and the epoch set with set_epoch, and takes every
+        num_replicas-th batch of it starting at rank.
+
+        Args:
+            num_items (int): Number of items in the dataset.
+            batch_size (int): Number of items per batch.
+            shuffle (bool): Whether to shuffle the items every epoch.
+            num_replicas (int): Number of processes sharing the dataset.
+            rank (int): Index of this process among them.
+            seed (int): Seed of the permutation, required to shuffle with
+                more than one replica. Defaults to the global torch RNG.
+            drop_last (bool): Whether to drop the last batches that cannot
+                be spread evenly across the replicas, so that all replicas
+                run the same number of steps.
+        """
+        if shuffle and num_replicas > 1 and seed is None:
+            raise ValueError("Shuffling across replicas requires a seed")
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle and self.seed is not None:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            idxes = torch.randperm(self.num_items, generator=generator).numpy()
+        elif self.shuffle:
+            idxes = torch.randperm(self.num_items).numpy()
+        else:
+            idxes = np.arange(self.num_items)
 
+        starts = range(0, self.num_items, self.batch_size)
+        if self.drop_last:
+            starts = starts[: len(self) * self.num_replicas]
+        for start in starts[self.rank :: self.num_replicas]:
+            batch = idxes[start : start + self.batch_size]
+            # Sorted indexes read the memory-mapped arrays more sequentially
+            yield np.sort(batch) if self.shuffle else batch
 
-def _is_end_of_line(tokens, i):
+    def __len__(self):
+        num_batches = -(-self.num_items // self.batch_size)
+        if self.drop_last:
+            return num_batches // self.num_replicas
+        return len(range(self.rank, num_batches, self.num_replicas))
+
+
+def batch_dataloader(
+    dataset,
+    batch_size,
+    shuffle=False,
+    num_workers=0,
+    num_replicas=1,
+    rank=0,
+    seed=None,
+):
     """
-    Check if the current token is the end of a line.
+    Create a DataLoader fetching whole batches from a TextDataset.
 
     Args:
-        tokens (list): List of tokens.
-        i (int): Current index.
+        dataset (TextDataset): The dataset.
+        batch_size (int): Number of items per batch.
+        shuffle (bool): Whether to shuffle the items every epoch.
+        num_workers (int): Number of DataLoader worker processes.
+        num_replicas (int): Number of processes sharing the dataset. When
+            shuffling, every process gets the same number of batches.
+        rank (int): Index of this process among them.
+        seed (int): Seed of the shuffling, see BatchIndexSampler.
 
     Returns:
-        bool: True if the current token is the end of a line, False
-        otherwise.
+        DataLoader: The DataLoader.
     """
-    num_tokens = len(tokens)
-    if i >= num_tokens:
-        raise ValueError("Index out of range")
-    return (
-        (i < (num_tokens - 1))
-        and (tokens[i] != "\n")
-        and (tokens[i + 1] == "\n")
+    sampler = BatchIndexSampler(
+        len(dataset),
+        batch_size,
+        shuffle,
+        num_replicas=num_replicas,
+        rank=rank,
+        seed=seed,
+        drop_last=shuffle and num_replicas > 1,
+    )
+    return DataLoader(
+        dataset,
+        sampler=sampler,
+        batch_size=None,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
     )
 
 
+def _cache_key(tokenizer, file_paths, padding):
+    """
+    Compute the cache key of a dataset.
+
+    Args:
+        tokenizer (object): Tokenizer to encode the texts.
+        file_paths (list): List of paths to the JSON data files.
+        padding (int): Padding size for the encoded texts.
+
+    Returns:
+        str: Hash of the tokenizer, the path, size and modification time of
+        each input file, and the padding.
+    """
+    key = hashlib.sha256(tokenizer.to_str().encode("utf-8"))
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        key.update(
+            f"{os.path.abspath(file_path)}:{stat.st_size}:"
+            f"{stat.st_mtime_ns}".encode("utf-8")
+        )
+    key.update(f"padding:{padding}".encode("utf-8"))
+    return key.hexdigest()[:32]
+
+
+def target_token_ids(tokenizer, target_tokens=None):
+    """
+    Map target tokens to their ids in the tokenizer vocabulary.
+
+    Args:
+        tokenizer (object): Tokenizer used to encode the texts.
+        target_tokens (list): List of target tokens, defaults to
+            TARGET_TOKENS.
+
+    Returns:
+        np.ndarray: Sorted unique ids of the target tokens present in the
+        vocabulary.
+    """
+    if target_tokens is None:
+        target_tokens = TARGET_TOKENS
+
+    ids = [tokenizer.token_to_id(token) for token in target_tokens]
+    return np.unique(np.array([i for i in ids if i is not None], np.int32))
+
+
+def candidate_mask(ids, target_ids, newline_id, context_size=0):
+    """
+    Find candidate sentence ends in an encoded text.
+
+    A token is a candidate if it is one of the target tokens, or if it is the
+    last token on a line, i.e. it is not a newline and the next token is.
+    The first and last context_size tokens are never candidates, they are
+    the padding or context around the tokens in between.
+
+    Args:
+        ids (np.ndarray): Token ids of the encoded text.
+        target_ids (np.ndarray): Ids of the target tokens.
+        newline_id (int): Id of the newline token, or None if the vocabulary
+            has no newline token.
+        context_size (int): Number of tokens on each side that are never
+            candidates.
+
+    Returns:
+        np.ndarray: Boolean mask over the tokens, True for candidates.
+    """
+    mask = np.isin(ids, target_ids)
+    if newline_id is not None:
+        is_newline = ids == newline_id
+        mask[:-1] |= ~is_newline[:-1] & is_newline[1:]
+    mask[:context_size] = False
+    mask[max(len(ids) - context_size, 0) :] = False
+    return mask
+
+
+def extract_windows(ids, token_idxes, context_size=6):
+    """
+    Gather the context windows centred on the given tokens.
+
+    The windows are taken from a strided view over the ids, so the encoded
+    text must be padded by at least context_size on both sides.
+
+    Args:
+        ids (np.ndarray): Token ids of the padded encoded text.
+        token_idxes (np.ndarray): Indexes of the tokens to centre windows on.
+        context_size (int): Size of the context window.
+
+    Returns:
+        np.ndarray: Array of shape (len(token_idxes), 2 * context_size + 1)
+        with the window ids.
+    """
+    window_size = 2 * context_size + 1
+    token_idxes = np.asarray(token_idxes, dtype=np.intp)
+    if len(token_idxes) and (
+        token_idxes.min() < context_size
+        or token_idxes.max() >= len(ids) - context_size
+    ):
+        raise ValueError(
+            f"Tokens within {context_size} of either end have no full window"
+        )
+    if len(ids) < window_size:
+        return np.empty((0, window_size), dtype=ids.dtype)
+    windows = sliding_window_view(ids, window_size)
+    return windows[token_idxes - context_size]
+
+
 def _label_tokens(offsets, ends):
     ends_idx = 0
     labels = []
@@ -0,0 +1,268 @@
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+CACHE_DIR = "./cache"
+ARTIFACTS_DIR = "./artifacts"
+THRESHOLD_FILE = "threshold.json"
+DEFAULT_THRESHOLD = 0.5
+
+
+def load_threshold(artifacts_dir):
+    """
+    Load the decision threshold of a model.
+
+    Args:
+        artifacts_dir (str): Directory containing the model artifacts.
+
+    Returns:
+        float: The threshold written by save_threshold, or DEFAULT_THRESHOLD
+        for artifacts without one.
+    """
+    path = Path(artifacts_dir) / THRESHOLD_FILE
+    if not path.exists():
+        return DEFAULT_THRESHOLD
+    with open(path, "r") as f:
+        return float(json.load(f)["threshold"])
+
+
+def save_threshold(artifacts_dir, threshold, metrics=None):
+    """
+    Write the decision threshold of a model next to its other artifacts.
+
+    Args:
+        artifacts_dir (str): Directory containing the model artifacts.
+        threshold (float): Probability above which a candidate is a sentence
+            end.
+        metrics (dict): Validation metrics at the threshold, saved for
+            reference.
+    """
+    with open(Path(artifacts_dir) / THRESHOLD_FILE, "w") as f:
+        json.dump({"threshold": threshold, **(metrics or {})}, f, indent=2)
+
+
+def _probabilities_cache_key(model, window_ids):
+    """
+    Compute the cache key of the probabilities of a model on a dataset.
+
+    Args:
+        model (CNNModel): The model.
+        window_ids (np.ndarray): The context windows of the dataset.
+
+    Returns:
+        str: Hash of the model weights and of the windows.
+    """
+    key = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        key.update(name.encode("utf-8"))
+        key.update(tensor.cpu().numpy().tobytes())
+    key.update(np.ascontiguousarray(window_ids).tobytes())
+    return key.hexdigest()[:32]
+
+
+def cached_probabilities(
+    model, dataset, cache_dir=CACHE_DIR, batch_size=65536
+):
+    """
+    Score a dataset once, caching the probabilities on disk.
+
+    Args:
+        model (CNNModel): The model.
+        dataset (TextDataset): The dataset to score.
+        cache_dir (str): Directory of the cache, or None not to cache.
+        batch_size (int): Number of windows scored at a time.
+
+    Returns:
+        tuple: The probability and the label of each window of the dataset.
+    """
+    labels = np.asarray(dataset.windows_labels, dtype=bool)
+    if cache_dir is not None:
+        key = _probabilities_cache_key(model, dataset.window_ids)
+        path = Path(cache_dir) / f"probs-{key}.npy"
+        if path.exists():
+            return np.load(path), labels
+
+    model.eval()
+    probs = [np.empty(0, dtype=np.float32)]
+    with torch.no_grad():
+        for start in range(0, len(dataset.window_ids), batch_size):
+            # Copied, torch cannot wrap the read-only memory-mapped windows
+            batch = np.array(dataset.window_ids[start : start + batch_size])
+            probs.append(model(torch.from_numpy(batch)).flatten().numpy())
+    probs = np.concatenate(probs)
+
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npy")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, probs)
+        os.replace(tmp_path, path)
+    return probs, labels
+
+
+def sweep(probs, labels, num_thresholds=1001):
+    """
+    Compute the precision, recall and F1 score at many thresholds at once.
+
+    A candidate is a sentence end when its probability is strictly above the
+    threshold, as in inference.py. The probabilities are sorted once, and the
+    number of true positives above each threshold is read from the cumulative
+    count of sentence ends.
+
+    Args:
+        probs (np.ndarray): Probability of each window.
+        labels (np.ndarray): Label of each window.
+        num_thresholds (int): Number of thresholds evenly spaced in [0, 1].
+
+    Returns:
+        dict: Arrays of the thresholds, and of the true positives, false
+        positives, false negatives, precision, recall and F1 score at each
+        threshold.
+    """
+    order = np.argsort(probs, kind="stable")
+    sorted_probs = probs[order]
+    ends_below = np.concatenate([[0], np.cumsum(labels[order])])
+    num_ends = int(ends_below[-1])
+
+    thresholds = np.arange(num_thresholds) / (num_thresholds - 1)
+    num_below = np.searchsorted(sorted_probs, thresholds, side="right")
+    TP = num_ends - ends_below[num_below]
+    FP = (len(probs) - num_below) - TP
+    FN = num_ends - TP
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(TP + FP > 0, TP / (TP + FP), 0.0)
+        recall = np.where(TP + FN > 0, TP / (TP + FN), 0.0)
+        f1_score = np.where(
+            precision + recall > 0,
+            2 * precision * recall / (precision + recall),
+            0.0,
+        )
+
+    return {
+        "Threshold": thresholds,
+        "True Positives": TP,
+        "False Positives": FP,
+        "False Negatives": FN,
+        "Precision": precision,
+        "Recall": recall,
+        "F1 Score": f1_score,
+    }
+
+
+def best_threshold(curve):
+    """
+    Find the threshold with the highest F1 score.
+
+    Args:
+        curve (dict): Output of sweep.
+
+    Returns:
+        tuple: The threshold, and its precision, recall and F1 score.
+    """
+    best = int(np.argmax(curve["F1 Score"]))
+    return float(curve["Threshold"][best]), {
+        "precision": float(curve["Precision"][best]),
+        "recall": float(curve["Recall"][best]),
+        "f1": float(curve["F1 Score"][best]),
+    }
+
+
+def tune_threshold(model, dataset, artifacts_dir, num_thresholds=1001):
+    """
+    Pick the threshold maximising the F1 score and save it in the artifacts.
+
+    Args:
+        model (CNNModel): The trained model.
+        dataset (TextDataset): The validation set.
+        artifacts_dir (str): Directory containing the model artifacts.
+        num_thresholds (int): Number of thresholds evenly spaced in [0, 1].
+
+    Returns:
+        tuple: The threshold, its metrics, and the full curve from sweep.
+    """
+    probs, labels = cached_probabilities(model, dataset)
+    curve = sweep(probs, labels, num_thresholds)
+    threshold, metrics = best_threshold(curve)
+    save_threshold(artifacts_dir, threshold, metrics)
+    return threshold, metrics, curve
+
+
+def save_curve(curve, path):
+    """
+    Write a precision-recall curve to a CSV file.
+
+    Args:
+        curve (dict): Output of sweep.
+        path (str): Path of the CSV file.
+    """
+    np.savetxt(
+        path,
+        np.column_stack(list(curve.values())),
+        delimiter=",",
+        fmt="%.6g",
+        header=",".join(curve),
+        comments="",
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pick the decision threshold of a trained model."
+    )
+    parser.add_argument(
+        "--val-files",
+        nargs="+",
+        default=["../data/sbd_adjudicatory_dec/data_set/cyber_crime.json"],
+        help="JSON data files of the validation set.",
+    )
+    parser.add_argument(
+        "--num-thresholds",
+        type=int,
+        default=1001,
+        help="Number of thresholds evenly spaced in [0, 1].",
+    )
+    parser.add_argument(
+        "--curve",
+        help="Path of a CSV file to write the precision-recall curve to.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    from tokenizers import Tokenizer
+
+    import backends
+    import text_dataset
+
+    args = parse_args()
+    artifacts_dir = Path(ARTIFACTS_DIR)
+
+    tokenizer = Tokenizer.from_file(str(artifacts_dir / "tokenizer.json"))
+    model = backends.load_model(artifacts_dir)
+    val_dataset = text_dataset.TextDataset.from_files(
+        args.val_files, tokenizer
+    )
+
+    threshold, metrics, curve = tune_threshold(
+        model, val_dataset, artifacts_dir, args.num_thresholds
+    )
+    if args.curve:
+        save_curve(curve, args.curve)
+
+    default = int(np.argmin(np.abs(curve["Threshold"] - DEFAULT_THRESHOLD)))
+    print(f"f1 at {DEFAULT_THRESHOLD}: {curve['F1 Score'][default]}")
+    print(
+        f"threshold: {threshold}, precision: {metrics['precision']}, "
+        f"recall: {metrics['recall']}, f1: {metrics['f1']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,75 @@
+import argparse
+import os
+import socket
+import time
 from pathlib import Path
 
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+
+import backends
 import cnn
 import data_prep
 import text_dataset
-import torch
-from torch.utils.data import DataLoader
+import thresholds
 
+ARTIFACTS_DIR = "./artifacts"
 MODEL_SAVE_PATH = "./artifacts/model.pt"
 TOKENIZER_SAVE_PATH = "./artifacts/tokenizer.json"
 
 
-def predict(model, dataloader):
-    all_predictions = []
-    all_labels = []
-
-    for batch, labels in dataloader:
-
-        # Forward pass
-        predictions = model(batch)
-
-        all_predictions.append(predictions)
-        all_labels.append(labels)
-
-    all_predictions = torch.cat(all_predictions)
-    all_labels = torch.cat(all_labels)
-    return all_predictions, all_labels
+class ConfusionMatrix:
+    def __init__(self, threshold=0.5):
+        """
+        Confusion matrix accumulated one batch of predictions at a time.
+
+        Args:
+            threshold (float): Probability above which a prediction is a
+                sentence end.
+        """
+        self.threshold = threshold
+        # True negatives, false positives, false negatives, true positives
+        self.counts = torch.zeros(4, dtype=torch.int64)
+
+    def update(self, preds, targets):
+        # Strictly above, like thresholds.sweep and inference.py
+        preds = (preds.flatten() > self.threshold).long()
+        targets = targets.flatten().long()
+        self.counts += torch.bincount(targets * 2 + preds, minlength=4)
+
+    def metrics(self):
+        TN, FP, FN, TP = self.counts.tolist()
+
+        # Calculate Accuracy
+        total = TP + FP + TN + FN
+        accuracy = (TP + TN) / total if total > 0 else 0
+
+        # Calculate Precision, Recall, and F1 Score
+        precision = TP / (TP + FP) if (TP + FP) > 0 else 0
+        recall = TP / (TP + FN) if (TP + FN) > 0 else 0
+        f1_score = (
+            2 * (precision * recall) / (precision + recall)
+            if (precision + recall) > 0
+            else 0
+        )
+
+        # Confusion Matrix
+        confusion_matrix = torch.tensor([[TN, FP], [FN, TP]])
+
+        return {
+            "True Positives": TP,
+            "False Positives": FP,
+            "True Negatives": TN,
+            "False Negatives": FN,
+            "Accuracy": accuracy,
+            "Precision": precision,
+            "Recall": recall,
+            "F1 Score": f1_score,
+            "Confusion Matrix": confusion_matrix,
+        }
 
 
 def calculate_metrics(preds, targets):
@@ -34,50 +79,56 @@ def calculate_metrics(preds, targets):
     if not isinstance(targets, torch.Tensor):
         targets = torch.tensor(targets)
 
-    # Threshold predictions to binary values (assuming binary classification
-    # with threshold of 0.5)
-    preds = (preds >= 0.5).float()
-
-    # Calculate True Positives, False Positives, True Negatives, and False
-    # Negatives
-    TP = ((preds == 1) & (targets == 1)).sum().item()
-    FP = ((preds == 1) & (targets == 0)).sum().item()
-    TN = ((preds == 0) & (targets == 0)).sum().item()
-    FN = ((preds == 0) & (targets == 1)).sum().item()
-
-    # Calculate Accuracy
-    accuracy = (TP + TN) / (TP + FP + TN + FN)
-
-    # Calculate Precision, Recall, and F1 Score
-    precision = TP / (TP + FP) if (TP + FP) > 0 else 0
-    recall = TP / (TP + FN) if (TP + FN) > 0 else 0
-    f1_score = (
-        2 * (precision * recall) / (precision + recall)
-        if (precision + recall) > 0
-        else 0
-    )
+    confusion_matrix = ConfusionMatrix()
+    confusion_matrix.update(preds, targets)
+    return confusion_matrix.metrics()
+
+
+def _is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
 
-    # Confusion Matrix
-    confusion_matrix = torch.tensor([[TN, FP], [FN, TP]])
+def evaluate(model, dataloader):
+    """
+    Calculate the metrics of a model, without keeping its predictions.
 
-    return {
-        "True Positives": TP,
-        "False Positives": FP,
-        "True Negatives": TN,
-        "False Negatives": FN,
-        "Accuracy": accuracy,
-        "Precision": precision,
-        "Recall": recall,
-        "F1 Score": f1_score,
-        "Confusion Matrix": confusion_matrix,
-    }
+    In distributed training, each process evaluates its shard of the
+    dataloader and the confusion matrices of all processes are summed.
+
+    Args:
+        model (CNNModel): The model.
+        dataloader (DataLoader): Batches of windows and labels.
+
+    Returns:
+        dict: The metrics returned by ConfusionMatrix.metrics.
+    """
+    confusion_matrix = ConfusionMatrix()
+    model.eval()
+    with torch.no_grad():
+        for batch, labels in dataloader:
+            confusion_matrix.update(model(batch), labels)
+    if dist.is_initialized():
+        dist.all_reduce(confusion_matrix.counts)
+    return confusion_matrix.metrics()
 
 
 def train(
-    model, train_dataloader, val_dataloader, optimizer, criterion, num_epochs
+    model,
+    train_dataloader,
+    val_dataloader,
+    optimizer,
+    criterion,
+    num_epochs,
+    train_eval_dataloader=None,
+    verbose=True,
 ):
+    verbose = verbose and _is_main_process()
     for epoch in range(num_epochs):
-        print(f"Epoch: {epoch+1}")
+        if verbose:
+            print(f"Epoch: {epoch+1}")
+        if hasattr(train_dataloader.sampler, "set_epoch"):
+            train_dataloader.sampler.set_epoch(epoch)
+        start = time.perf_counter()
         model.train()
         for batch, labels in train_dataloader:
 
@@ -91,48 +142,102 @@ def train(
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
-
-        model.eval()
-        with torch.no_grad():
-            train_predictions, train_labels = predict(model, train_dataloader)
-            val_predictions, val_labels = predict(model, val_dataloader)
-            val_metrics = calculate_metrics(
-                val_predictions.flatten(), val_labels
-            )
-            train_metrics = calculate_metrics(
-                train_predictions.flatten(), train_labels
+        train_time = time.perf_counter() - start
+
+        # Without a validation set, e.g. in sweep workers that evaluate
+        # the trained model once, there is nothing to evaluate per epoch
+        if val_dataloader is None:
+            if verbose:
+                print(f"train time: {train_time:.1f}s")
+            continue
+
+        start = time.perf_counter()
+        val_metrics = evaluate(model, val_dataloader)
+        if train_eval_dataloader is not None:
+            train_metrics = evaluate(model, train_eval_dataloader)
+        eval_time = time.perf_counter() - start
+
+        if verbose:
+            print(f"val f1: {val_metrics['F1 Score']}")
+            if train_eval_dataloader is not None:
+                print(f"train f1: {train_metrics['F1 Score']}")
+            print(
+                f"train time: {train_time:.1f}s, eval time: {eval_time:.1f}s"
             )
-            print(f"val f1: {val_metrics["F1 Score"]}")
-            print(f"train f1: {train_metrics["F1 Score"]}")
 
 
-def main():
-    train_files = [
-        "../data/sbd_adjudicatory_dec/data_set/intellectual_property.json",
-        "../data/sbd_adjudicatory_dec/data_set/bva.json",
-        "../data/sbd_adjudicatory_dec/data_set/scotus.json",
-    ]
-
-    val_files = [
-        "../data/sbd_adjudicatory_dec/data_set/cyber_crime.json",
-    ]
-
-    processed_train_data = data_prep.read_texts_from_json_files(train_files)
-    processed_val_data = data_prep.read_texts_from_json_files(val_files)
+def train_eval_dataloader(
+    dataset, mode, sample_size, num_workers=0, num_replicas=1, rank=0
+):
+    """
+    Create the DataLoader used to evaluate the model on the training set.
+
+    Args:
+        dataset (TextDataset): The training set.
+        mode (str): "full" to evaluate on the whole training set, "sample"
+            on a fixed random subset of sample_size windows, "off" not to
+            evaluate on the training set.
+        sample_size (int): Number of windows in the subset.
+        num_workers (int): Number of DataLoader worker processes.
+        num_replicas (int): Number of processes sharing the evaluation.
+        rank (int): Index of this process among them.
+
+    Returns:
+        DataLoader: The DataLoader, or None if mode is "off".
+    """
+    if mode == "off":
+        return None
+    if mode == "full" or sample_size >= len(dataset):
+        return text_dataset.batch_dataloader(
+            dataset,
+            batch_size=1024,
+            num_workers=num_workers,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+
+    generator = torch.Generator().manual_seed(0)
+    idxes = torch.randperm(len(dataset), generator=generator)[:sample_size]
+    idxes = idxes.sort().values.numpy()
+    batches = [idxes[i : i + 1024] for i in range(0, len(idxes), 1024)]
+    return DataLoader(
+        dataset,
+        sampler=batches[rank::num_replicas],
+        batch_size=None,
+        num_workers=num_workers,
+    )
 
-    tokenizer = data_prep.prep_tokenizer(processed_train_data.texts)
 
-    train_dataset = text_dataset.TextDataset(
-        processed_train_data.texts, processed_train_data.ends, tokenizer
+def fit(model, train_dataset, val_dataset, args, num_replicas=1, rank=0):
+    """
+    Train a model on this process's shard of the training set.
+
+    Args:
+        model (nn.Module): The model, wrapped in DistributedDataParallel when
+            num_replicas is more than 1.
+        train_dataset (TextDataset): The training set.
+        val_dataset (TextDataset): The validation set.
+        args (argparse.Namespace): Command line arguments.
+        num_replicas (int): Number of training processes.
+        rank (int): Index of this process among them.
+    """
+    train_dataloader = text_dataset.batch_dataloader(
+        train_dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        num_replicas=num_replicas,
+        rank=rank,
+        seed=args.seed,
     )
-    val_dataset = text_dataset.TextDataset(
-        processed_val_data.texts, processed_val_data.ends, tokenizer
+    val_dataloader = text_dataset.batch_dataloader(
+        val_dataset,
+        batch_size=1024,
+        num_workers=args.num_workers,
+        num_replicas=num_replicas,
+        rank=rank,
     )
 
-    train_dataloader = DataLoader(train_dataset, batch_size=32, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, batch_size=1024, shuffle=False)
-
-    model = cnn.CNNModel()
     optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
     criterion = torch.nn.BCELoss()
 
@@ -143,13 +248,159 @@ def main():
         optimizer,
         criterion,
         num_epochs=5,
+        train_eval_dataloader=train_eval_dataloader(
+            train_dataset,
+            args.train_eval,
+            args.train_eval_size,
+            num_workers=args.num_workers,
+            num_replicas=num_replicas,
+            rank=rank,
+        ),
+    )
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _train_worker(
+    rank, world_size, port, model, train_dataset, val_dataset, args
+):
+    # Split the cores between the training processes, so that they do not
+    # compete for the same ones
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    dist.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=world_size,
+    )
+    try:
+        # DistributedDataParallel broadcasts the weights of rank 0 and
+        # all-reduces the gradients after every backward pass
+        fit(
+            DistributedDataParallel(model),
+            train_dataset,
+            val_dataset,
+            args,
+            num_replicas=world_size,
+            rank=rank,
+        )
+        if rank == 0:
+            torch.save(model.state_dict(), MODEL_SAVE_PATH)
+    finally:
+        dist.destroy_process_group()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the CNN model.")
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="Also export TorchScript, ONNX and int8 versions of the model "
+        "and check that they agree with it on the validation set.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of DataLoader worker processes.",
+    )
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of data-parallel training processes.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Number of training windows per batch and per process.",
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the shuffling of the training set, random by default.",
+    )
+    parser.add_argument(
+        "--train-eval",
+        choices=["full", "sample", "off"],
+        default="sample",
+        help="Evaluate on the whole training set after each epoch, on a "
+        "fixed random sample of it, or not at all.",
+    )
+    parser.add_argument(
+        "--train-eval-size",
+        type=int,
+        default=100_000,
+        help="Number of training windows evaluated with --train-eval sample.",
+    )
+    return parser.parse_args()
+
 
-    Path("./artifacts").mkdir(exist_ok=True)
+def main():
+    args = parse_args()
+
+    train_files = [
+        "../data/sbd_adjudicatory_dec/data_set/intellectual_property.json",
+        "../data/sbd_adjudicatory_dec/data_set/bva.json",
+        "../data/sbd_adjudicatory_dec/data_set/scotus.json",
+    ]
+
+    val_files = [
+        "../data/sbd_adjudicatory_dec/data_set/cyber_crime.json",
+    ]
+
+    tokenizer = data_prep.prep_tokenizer(
+        data_prep.JsonCorpus(train_files).texts
+    )
+
+    train_dataset = text_dataset.TextDataset.from_files(train_files, tokenizer)
+    val_dataset = text_dataset.TextDataset.from_files(val_files, tokenizer)
+
+    Path(ARTIFACTS_DIR).mkdir(exist_ok=True)
+
+    model = cnn.CNNModel()
+    if args.nproc > 1:
+        if args.seed is None:
+            # All processes must shuffle the training set the same way
+            args.seed = int(torch.randint(2**31, ()))
+        mp.spawn(
+            _train_worker,
+            args=(
+                args.nproc,
+                _free_port(),
+                model,
+                train_dataset,
+                val_dataset,
+                args,
+            ),
+            nprocs=args.nproc,
+        )
+        model.load_state_dict(torch.load(MODEL_SAVE_PATH))
+    else:
+        fit(model, train_dataset, val_dataset, args)
+        torch.save(model.state_dict(), MODEL_SAVE_PATH)
 
-    torch.save(model.state_dict(), MODEL_SAVE_PATH)
     tokenizer.save(TOKENIZER_SAVE_PATH)
 
+    threshold, metrics, _ = thresholds.tune_threshold(
+        model, val_dataset, ARTIFACTS_DIR
+    )
+    print(f"threshold: {threshold}, val f1: {metrics['f1']}")
+
+    if args.export:
+        backends.export(model, ARTIFACTS_DIR)
+        parity = backends.check_parity(ARTIFACTS_DIR, val_dataset.window_ids)
+        for backend, result in parity.items():
+            print(
+                f"{backend}: {result['mismatch']:.4%} of decisions differ, "
+                f"max probability difference {result['max_diff']:.2e}"
+            )
+
 
 if __name__ == "__main__":
     main()